@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of formattedrange: expansion with FormattedRange.get() and
+FormattedDateRange.get(), counting/lookups and the end-to-end throughput
+of main(), including the stdin batch mode.
+
+Each case runs in its own python process so that its peak RSS is not
+polluted by the other ones. The results are written as JSON so that two
+runs (e.g. two commits) can be compared:
+
+  % ./benchmarks/bench_formattedrange.py -o before.json
+  % git checkout other-commit
+  % ./benchmarks/bench_formattedrange.py -o after.json
+  % ./benchmarks/bench_formattedrange.py --compare before.json after.json
+  get_single_huge            1052341 items/s ->  1203311 items/s  x1.14
+  ...
+
+Use --quick for smaller inputs and -k <name> to run only some cases.
+"""
+import sys
+import os
+import getopt
+import json
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+myself = os.path.basename(sys.argv[0])
+
+usage_msg = 'Usage: ' + myself + ' [options...]' + """
+Options:
+ -h/--help                This help text
+ -o/--output <file>       Write the results as JSON to file (default stdout)
+ -r/--repeat <num>        Run each case num times and keep the best one
+ -k/--case <name>         Only run the given case (can be repeated)
+ -q/--quick               Use small inputs, e.g. to check the suite works
+ -l/--list                List the cases
+ --compare <old> <new>    Compare two JSON result files
+"""
+
+
+def case_get_single_huge(scale):
+    """ One bracket with a lot of values """
+    from formattedrange import FormattedRange
+    return len(FormattedRange("node[1-%d]" % int(2000000 * scale)).get())
+
+def case_get_multi_bracket(scale):
+    """ Cartesian product of three brackets """
+    from formattedrange import FormattedRange
+    fr = FormattedRange("node[0001-%04d]rack[01-32]x[1-16]" %
+                        int(2000 * scale))
+    return len(fr.get())
+
+def case_get_comma_heavy(scale):
+    """ One bracket made of many comma separated sub-ranges """
+    from formattedrange import FormattedRange
+    ranges = ",".join("%d-%d" % (i * 10, i * 10 + 4)
+                      for i in xrange(int(100000 * scale)))
+    return len(FormattedRange("b[%s]" % ranges).get())
+
+def case_get_dates(scale):
+    """ Many year-long daily date ranges """
+    from formattedrange import FormattedDateRange
+    items = 0
+    for i in xrange(int(1000 * scale)):
+        items += len(FormattedDateRange("h%d_[20120101-20121231]" % i,
+                                        date_format="%Y-%m-%d").get())
+    return items
+
+def case_count_and_index(scale):
+    """ len(), [] and index() on a huge product, without expanding it """
+    from formattedrange import FormattedRange
+    fr = FormattedRange("a[1-100000]b[0001-9999]c[1-50,70-90]")
+    total = len(fr)
+    items = 0
+    for i in xrange(0, total, total // int(100000 * scale)):
+        fr.index(fr[i])
+        items += 1
+    return items
+
+class CountingOutput(object):
+    """ A stdout which only counts the newlines written to it """
+    def __init__(self):
+        self.newlines = 0
+
+    def write(self, data):
+        self.newlines += data.count('\n')
+
+    def flush(self):
+        pass
+
+def _run_main(args, stdin=None):
+    """
+    Runs main() with its output discarded, and returns the number of
+    newlines it wrote. Raises RuntimeError if main() fails, e.g. on a
+    commit which does not have an option yet
+    """
+    from formattedrange import main
+    out = CountingOutput()
+    saved = sys.stdin, sys.stdout
+    try:
+        sys.stdout = out
+        if stdin is not None:
+            sys.stdin = stdin
+        ret = main(args)
+    finally:
+        sys.stdin, sys.stdout = saved
+    if ret:
+        raise RuntimeError("main(%r) returned %r" % (args, ret))
+    return out.newlines
+
+def case_main_cli(scale):
+    """ main() writing a big multi-bracket expansion to /dev/null """
+    pattern = "node[0001-%04d]rack[01-32]x[1-16]" % int(2000 * scale)
+    # One item per line, counted on the output
+    return _run_main(['-d', '\n', pattern])
+
+def case_main_batch(scale):
+    """ main() in batch mode with many short patterns on stdin """
+    lines = int(200000 * scale)
+    with tempfile.TemporaryFile() as f:
+        for i in xrange(lines):
+            f.write("h%d-[01-08]\n" % i)
+        f.seek(0)
+        return _run_main(['-b', '-d', '\n'], stdin=f)
+
+CASES = dict((name[len('case_'):], func) for name, func in globals().items()
+             if name.startswith('case_'))
+
+
+def run_case(name, scale):
+    """ Runs a case in this process and returns its measures """
+    start = time.time()
+    items = CASES[name](scale)
+    seconds = time.time() - start
+    return {'name': name, 'items': items, 'seconds': seconds,
+            'items_per_s': items / seconds if seconds else None,
+            # Kilobytes on Linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def run_in_child(name, scale):
+    """
+    Runs a case in a new python process and returns its measures, or None
+    if it failed
+    """
+    try:
+        out = subprocess.check_output([sys.executable,
+                                       os.path.abspath(__file__),
+                                       '--run-case', name,
+                                       '--scale', str(scale)])
+    except subprocess.CalledProcessError:
+        return None
+    return json.loads(out)
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_file, new_file):
+    """ Prints the throughput of each case in both result files """
+    with open(old_file) as f:
+        old = dict((r['name'], r) for r in json.load(f)['results'])
+    with open(new_file) as f:
+        new = dict((r['name'], r) for r in json.load(f)['results'])
+    for name in sorted(set(old) & set(new)):
+        a, b = old[name]['items_per_s'], new[name]['items_per_s']
+        if not a or not b:
+            # Too fast to be measured
+            sys.stdout.write("%-24s no throughput to compare\n" % name)
+            continue
+        sys.stdout.write("%-24s %10d items/s -> %10d items/s  x%.2f  "
+                         "(rss %d -> %d KB)\n" %
+                         (name, a, b, b / a, old[name]['peak_rss_kb'],
+                          new[name]['peak_rss_kb']))
+    return 0
+
+def main(args=None):
+    output = None
+    repeat = 3
+    scale = 1
+    names = []
+    run_case_name = None
+
+    try:
+        opts, remainder = getopt.getopt(args or sys.argv[1:], "ho:r:k:ql",
+                                        ['help', 'output=', 'repeat=', 'case=',
+                                         'quick', 'list', 'compare',
+                                         'run-case=', 'scale='])
+    except getopt.GetoptError, err:
+        sys.stderr.write("Error: %s\n" % err)
+        return 1
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            sys.stdout.write(usage_msg)
+            return 0
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-r', '--repeat'):
+            repeat = int(a)
+        elif o in ('-k', '--case'):
+            if a not in CASES:
+                sys.stderr.write("Error: unknown case %s\n" % a)
+                return 1
+            names.append(a)
+        elif o in ('-q', '--quick'):
+            # Inputs are divided by 100
+            scale = 0.01
+        elif o in ('-l', '--list'):
+            for name in sorted(CASES):
+                sys.stdout.write("%-24s %s\n" % (name,
+                                                 CASES[name].__doc__.strip()))
+            return 0
+        elif o == '--compare':
+            if len(remainder) != 2:
+                sys.stderr.write("Error: --compare needs two files\n")
+                return 1
+            return compare(*remainder)
+        elif o == '--run-case':
+            run_case_name = a
+        elif o == '--scale':
+            scale = float(a)
+
+    if run_case_name:
+        # Internal: run one case in this (child) process
+        json.dump(run_case(run_case_name, scale), sys.stdout)
+        return 0
+
+    results = []
+    for name in names or sorted(CASES):
+        best = None
+        for i in range(repeat):
+            res = run_in_child(name, scale)
+            if res is None:
+                break
+            if best is None or res['seconds'] < best['seconds']:
+                best = res
+        if best is None:
+            # Its traceback was printed by the child
+            sys.stderr.write("%-24s FAILED\n" % name)
+            continue
+        sys.stderr.write("%-24s %10d items %8.3f s %12d items/s %8d KB\n" %
+                         (name, best['items'], best['seconds'],
+                          best['items_per_s'] or 0, best['peak_rss_kb']))
+        results.append(best)
+
+    report = {'commit': git_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'time': time.time(),
+              'repeat': repeat, 'scale': scale, 'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,37 @@ or at the following URL: http://linux.die.net/man/5/dhcpd.leases
 
 The default location of the DHCP leases file is: /var/lib/dhcp/dhcpd.leases
 
+Two parsing engines are available:
+- 'pyparsing' (default): the reference implementation, based on a PyParsing
+  grammar run over the whole file
+- 'tokenizer': a hand-written tokenizer and state machine for the same
+  grammar, which goes over the file in one streaming pass and is much
+  faster on big files
+
+  lease_parser = DhcpLeasesParser('/var/lib/dhcp/dhcpd.leases',
+                                  engine='tokenizer')
+
+A parser can follow the file as dhcpd appends leases to it: refresh() only
+parses the complete blocks added since the previous call, and starts over
+when the file has been rewritten.
+
+  lease_parser.parse()
+  ...
+  lease_parser.refresh()
+
+With history=<depth>, the last depth lease entries of each IP and MAC
+address are kept too (see get_history_by_ip() and get_history_by_mac()).
+
+With snapshot=True, the results are also saved to a snapshot file next to
+the leases file (dhcpd.leases.snapshot), so that a new process starts from
+them instead of parsing the whole file again. It is saved by the first
+parse() and after full parses; call save_snapshot() to save it after
+refresh(). The snapshot must not be writable by untrusted users.
+
+With compact=True the hosts are kept as Host records, which take several
+times less memory than dicts on big lease tables but can be read the same
+way.
+
 Dependencies:
 python-pyparsing
 
@@ -16,29 +47,803 @@ SPDX-License-Identifier: GPL-2.0
 from pyparsing import (nums, hexnums, alphanums, Suppress, Combine, Word,
                        Literal, oneOf, ZeroOrMore, Group, QuotedString, Dict,
                        Optional, restOfLine)
+import collections
+import bisect
+import csv
 import datetime
+import gc
+import getopt
+import json
+import os
 import time
 import re
 import logging
+import marshal
+import mmap
+import multiprocessing
+import signal
+import sys
 
 logger = logging.getLogger(__name__)
 
 IPV4ADDR_RE = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"
+ipv4addr_re = re.compile(IPV4ADDR_RE)
+# A line holding a lease entry, for the counts of entries and duplicates
+lease_entry_re = re.compile(r'^(?!#)[^\n]*?lease[^\S\n]+' + IPV4ADDR_RE +
+                            r'\s', re.MULTILINE)
+# A backslash escape in a quoted string: octal (\001) or of one character
+string_escape_re = re.compile(r'\\([0-7]{1,3}|.)')
+string_escapes = {'t': '\t', 'n': '\n', 'f': '\f', 'r': '\r'}
+
+ENGINES = ('pyparsing', 'tokenizer')
+
+# Size of the blocks read by the tokenizer engine
+READ_SIZE = 1024 * 1024
+# Number of bytes checked to make sure the file was only appended to
+TAIL_SIZE = 256
+# Smallest range of a leases file parsed by one process with jobs > 1
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+# Default snapshot file: leases_filename + SNAPSHOT_SUFFIX
+SNAPSHOT_SUFFIX = '.snapshot'
+# Bumped when the contents of the snapshot files change
+SNAPSHOT_VERSION = 3
+
+# Fields of the rows of iter_leases() and of the --format output
+FIELDS = ('ip_addr', 'binding_state', 'next_binding_state', 'mac_addr',
+          'hardware_type', 'client_hostname', 'uid', 'starts', 'ends', 'tstp',
+          'tsfp', 'atsfp', 'cltt')
+DEFAULT_FIELDS = ('ip_addr', 'binding_state', 'mac_addr', 'client_hostname',
+                  'starts', 'ends', 'cltt')
+FORMATS = ('jsonl', 'csv', 'tsv')
+# The --format output is flushed every FLUSH_ROWS rows
+FLUSH_ROWS = 1000
+
+myself = os.path.basename(sys.argv[0])
+
+usage_msg = 'Usage: ' + myself + ' [options...] <dhcpd.leases>' + """
+Without --format, prints the active hosts and the counts of lease entries.
+Options:
+ -h/--help                This help text
+ -e/--engine <name>       Parsing engine: pyparsing or tokenizer (default:
+                          pyparsing, tokenizer with --format)
+ -f/--format <format>     Write one row per lease block, as soon as it is
+                          parsed, in the jsonl, csv or tsv format
+ -F/--fields <f1,f2...>   The fields of the rows, among: ip_addr,
+                          binding_state, next_binding_state, mac_addr,
+                          hardware_type, client_hostname, uid, starts, ends,
+                          tstp, tsfp, atsfp, cltt (default: ip_addr,
+                          binding_state, mac_addr, client_hostname, starts,
+                          ends, cltt)
+ -a/--active-only         Only write the active leases
+"""
+
+# Max number of decoded timestamps kept by decode_timestamp()
+TIMESTAMP_CACHE_SIZE = 64 * 1024
+timestamp_cache = {}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+# Timestamp of 'ends never;'
+NEVER = sys.maxint
+
+def epoch2localtime(epoch):
+    """
+    Converts seconds since the epoch to local date and time strings like
+    ('2015-08-13', '12:58:00'), with the DST rules of the local timezone
+    """
+    try:
+        tm = time.localtime(epoch)
+    except (ValueError, OverflowError):
+        # Out of the range of the platform, so without DST
+        tm = (EPOCH + datetime.timedelta(0, epoch - time.timezone)).timetuple()
+    return ('%04d-%02d-%02d' % tm[:3], '%02d:%02d:%02d' % tm[3:6])
+
+def decode_timestamp(utcdate, utctime):
+    """
+    Decodes UTC date and time strings like ('2015/08/13', '10:58:00') to
+    (seconds since the epoch, local date, local time), e.g. (1439463480,
+    '2015-08-13', '12:58:00'). The results are cached by timestamp as the
+    same ones come back a lot in a leases file, so timestamp_cache must be
+    cleared if the local timezone changes
+    """
+    key = utcdate + ' ' + utctime
+    try:
+        return timestamp_cache[key]
+    except KeyError:
+        pass
+    digits = (key[:4] + key[5:7] + key[8:10] + key[11:13] + key[14:16] +
+              key[17:])
+    if (len(key) != 19 or not digits.isdigit() or key[4] != '/' or
+            key[7] != '/' or key[10] != ' ' or key[13] != ':' or
+            key[16] != ':'):
+        raise ValueError("time data %r does not match format "
+                         "'%%Y/%%m/%%d %%H:%%M:%%S'" % key)
+    hours, minutes, seconds = int(key[11:13]), int(key[14:16]), int(key[17:])
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError("time data %r is out of range" % key)
+    days = datetime.date(int(key[:4]), int(key[5:7]),
+                         int(key[8:10])).toordinal() - EPOCH_ORDINAL
+    epoch = days * 86400 + hours * 3600 + minutes * 60 + seconds
+    decoded = (epoch,) + epoch2localtime(epoch)
+    if len(timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        timestamp_cache.clear()
+    timestamp_cache[key] = decoded
+    return decoded
+
+def utc2localtime(utcdate, utctime):
+    """
+    Converts UTC date and time strings like ('2015/08/13', '10:58:00') to
+    local ('2015-08-13', '12:58:00')
+    """
+    return decode_timestamp(utcdate, utctime)[1:]
+
+def utc2epoch(utcdate, utctime):
+    """
+    Converts UTC date and time strings like ('2015/08/13', '10:58:00') to
+    seconds since the epoch
+    """
+    return decode_timestamp(utcdate, utctime)[0]
+
+def unescape(value):
+    """
+    Returns the contents of a quoted string with its backslash escapes
+    decoded, the octal ones included: dhcpd writes the binary bytes of a
+    uid as e.g. "\\001\\000\\021"
+    """
+    def decode(found):
+        esc = found.group(1)
+        if esc[0] in '01234567':
+            return chr(int(esc, 8) & 0xff)
+        return string_escapes.get(esc, esc)
+    return string_escape_re.sub(decode, value)
+
+def complete_blocks_end(buf, start=0):
+    """
+    Returns the end of the part of buf (a string or a mmap) after start made
+    of complete top-level statements, i.e. the end of the last line which
+    closes a block: a line starting with '}' (as dhcpd writes them) or a
+    whole block on one line. Returns start if there is no such line
+    """
+    end = len(buf)
+    while end > start:
+        line_start = max(buf.rfind('\n', start, end - 1) + 1, start)
+        line = buf[line_start:end]
+        if line.rstrip().endswith('}') and not line[0].isspace():
+            return end
+        end = line_start
+    return start
+
+
+def iter_blocks(buf, start, end):
+    """
+    Yields buf[start:end] (buf being a string or a mmap) in blocks of about
+    READ_SIZE bytes, each one but the last ending with a newline
+    """
+    while start < end:
+        stop = min(start + READ_SIZE, end)
+        if stop < end:
+            cut = buf.rfind('\n', start, stop) + 1
+            if cut > start:
+                stop = cut
+            else:
+                # A line longer than READ_SIZE
+                stop = buf.find('\n', stop, end) + 1 or end
+        yield buf[start:stop]
+        start = stop
+
+
+def read_blocks(leasesf):
+    """
+    Yields the rest of a file in blocks of about READ_SIZE bytes, each one
+    but the last ending with a newline, like iter_blocks()
+    """
+    tail = ''
+    while True:
+        block = leasesf.read(READ_SIZE)
+        if not block:
+            break
+        block = tail + block
+        cut = block.rfind('\n') + 1
+        tail = block[cut:]
+        if cut:
+            yield block[:cut]
+    if tail:
+        yield tail
+
+
+def split_ranges(buf, start, end, count):
+    """
+    Splits buf[start:end] in at most count (start, end) ranges of at least
+    PARALLEL_CHUNK_SIZE bytes, each one starting with a line which starts
+    with the 'lease' keyword. Such a line always starts a new lease block
+    for both engines, so the ranges can be parsed separately
+    """
+    size = max((end - start) // max(count, 1), PARALLEL_CHUNK_SIZE)
+    ranges = []
+    pos = start
+    while pos < end:
+        cut = pos + size
+        while cut < end:
+            cut = buf.find('\nlease', cut, end)
+            if cut < 0:
+                cut = end
+            elif cut + 6 < end and buf[cut + 6].isspace():
+                cut += 1
+                break
+            else:
+                cut += 6
+        cut = min(cut, end)
+        ranges.append((pos, cut))
+        pos = cut
+    return ranges
+
+
+def parse_range(task):
+    """
+    Parses a range of a leases file (in a pool process, see
+    DhcpLeasesParser._parse_parallel()). Returns the IP addresses of the
+    lease entries, the records of the active leases and the history entries
+    of all the leases if needed, in file order
+    """
+    leases_filename, inode, engine, compact, history, start, end = task
+    parser = DhcpLeasesParser(leases_filename, engine=engine, compact=compact)
+    entries = []
+    records = []
+    events = []
+    with open(leases_filename, 'rb') as leasesf:
+        st = os.fstat(leasesf.fileno())
+        if (st.st_dev, st.st_ino) != inode:
+            raise IOError("%s was replaced while parsed" % leases_filename)
+        buf = mmap.mmap(leasesf.fileno(), end, access=mmap.ACCESS_READ)
+    try:
+        for lease in parser._iter_leases(buf, start, end, entries.append):
+            if history:
+                events.append(parser._event(lease))
+            record = parser._record(lease)
+            if record is not None:
+                records.append(record)
+    finally:
+        buf.close()
+    return entries, records, events
+
+
+class LeasesTokenizer(object):
+    """
+    A hand-written parser for the same grammar as DhcpLeasesParser._setup(),
+    which reads the leases in one streaming pass over blocks of lines (see
+    iter_blocks()). The text is split in tokens (words, quoted strings and
+    braces/semicolons, comments being dropped) and a small state machine
+    turns each valid lease block into a dict shaped like the PyParsing
+    results: {'ipaddress': ..., 'binding': 'active', 'hardware': {'type':
+    ..., 'mac': ...}, 'starts': {'weekday': ..., 'utcdate': ...,
+    'localdate': ...}, ...}.
+
+    Like with PyParsing, a lease block holding anything else than the known
+    statements is skipped, and the search restarts at the failing token.
+    The only known difference is a client-hostname string ending with a
+    backslash, which PyParsing accepts and this parser rejects.
+    """
+    token_re = re.compile(r'"(?:[^"\n\r\\]|\\.)*"|"[^\n]*|#[^\n]*|[{};]|'
+                          r'[^\s{};"#]+')
+    string_re = re.compile(r'"((?:[^"\n\r\\]|\\.)*)"$')
+    escaped_re = re.compile(r'\\(.)')
+    ipaddr_re = re.compile(r'\d+(?:\.\d+){3}$')
+    macaddr_re = re.compile(r'[0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5}$')
+    hwtype_re = re.compile(r'[0-9a-zA-Z]+$')
+    weekday_re = re.compile(r'[0-6]$')
+    date_re = re.compile(r'(?:\d{4}|\d{2})/\d{2}/\d{2}$')
+    time_re = re.compile(r'\d{2}:\d{2}:\d{2}$')
+
+    dates = ('starts', 'ends', 'tstp', 'tsfp', 'atsfp', 'cltt')
+    bind_states = ('active', 'free', 'backup', 'expired', 'abandoned')
+    statements = dates + ('hardware', 'uid', 'binding', 'next',
+                          'client-hostname')
+    # Escaped whitespace is converted in quoted strings (like PyParsing does)
+    ws_map = ((r'\t', '\t'), (r'\n', '\n'), (r'\f', '\f'), (r'\r', '\r'))
+
+    def tokens(self, blocks):
+        """ Yields the tokens of the given blocks of whole lines """
+        # Tokens never span lines, so they never span blocks either
+        for block in blocks:
+            for tok in self.token_re.findall(block):
+                if tok[0] != '#':
+                    yield tok
+
+    def _string(self, tok, escaped):
+        """
+        Returns the contents of a quoted string token, or None if tok is not
+        a valid string (with backslash escapes if escaped is True)
+        """
+        found = self.string_re.match(tok)
+        if not found:
+            return None
+        value = found.group(1)
+        if not escaped and '\\"' in tok[:-1]:
+            # Without escapes the string would end at this quote
+            return None
+        if '\\' in value:
+            for wslit, wschar in self.ws_map:
+                value = value.replace(wslit, wschar)
+            if escaped:
+                value = self.escaped_re.sub(r'\1', value)
+        return value
+
+    def _value(self, keyword, args):
+        """
+        Returns the value of a lease statement given its arguments, or None
+        if they do not follow the grammar
+        """
+        if keyword in self.dates:
+            if keyword == 'ends' and args == ['never']:
+                return 'never'
+            if (len(args) == 3 and self.weekday_re.match(args[0]) and
+                    self.date_re.match(args[1]) and
+                    self.time_re.match(args[2])):
+                localdate, localtime = utc2localtime(args[1], args[2])
+                return {'weekday': args[0], 'utcdate': args[1],
+                        'utctime': args[2], 'localdate': localdate,
+                        'localtime': localtime}
+        elif keyword == 'hardware':
+            if (len(args) == 2 and self.hwtype_re.match(args[0]) and
+                    self.macaddr_re.match(args[1])):
+                return {'type': args[0], 'mac': args[1]}
+        elif keyword == 'uid':
+            if len(args) == 1 and self.string_re.match(args[0]):
+                return unescape(args[0][1:-1])
+        elif keyword == 'client-hostname':
+            if len(args) == 1:
+                return self._string(args[0], False)
+        elif keyword == 'binding':
+            if (len(args) == 2 and args[0] == 'state' and
+                    args[1] in self.bind_states):
+                return args[1]
+        elif keyword == 'next':
+            if (len(args) == 3 and args[:2] == ['binding', 'state'] and
+                    args[2] in self.bind_states):
+                return ['binding', args[2]]
+        return None
+
+    def _lease(self, tokens):
+        """
+        Reads a lease block after the 'lease' keyword. Returns the lease
+        dict (or None if the block is not valid) and the next token to look
+        at
+        """
+        tok = next(tokens, None)
+        if tok is None or not self.ipaddr_re.match(tok):
+            return None, tok
+        lease = {'ipaddress': tok}
+        tok = next(tokens, None)
+        if tok != '{':
+            return None, tok
+        while True:
+            keyword = next(tokens, None)
+            if keyword == '}':
+                return lease, next(tokens, None)
+            if keyword not in self.statements:
+                return None, keyword
+            args = []
+            tok = next(tokens, None)
+            while tok != ';':
+                if tok in (None, '{', '}', 'lease') or len(args) == 3:
+                    return None, tok
+                args.append(tok)
+                tok = next(tokens, None)
+            value = self._value(keyword, args)
+            if value is None:
+                return None, next(tokens, None)
+            # Later statements supersede earlier ones
+            lease[keyword] = value
+
+    def scan(self, blocks):
+        """ Yields a dict for each valid lease block of the blocks of lines """
+        tokens = self.tokens(blocks)
+        tok = next(tokens, None)
+        while tok is not None:
+            if tok != 'lease':
+                tok = next(tokens, None)
+                continue
+            lease, tok = self._lease(tokens)
+            if lease is not None:
+                yield lease
+
+
+class HostTable(object):
+    """
+    The table of the active hosts (dicts or Host records with 'ip_addr',
+    'mac_addr' and 'client_hostname' keys), kept in insertion order and
+    indexed by IP address, MAC address and client hostname
+    """
+    def __init__(self):
+        # Hosts are never removed, so a list is enough to keep their order
+        self._by_ip = {}
+        self._ips = []
+        # MAC address/hostname -> IP address, or OrderedDict of IP addresses
+        # (least recently updated first) if there are several, so that a
+        # host can be moved or removed in O(1) even if many share its key
+        self._by_mac = {}
+        self._by_hostname = {}
+        # IP address -> (MAC address, hostname) under which it is indexed
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._by_ip)
+
+    def __iter__(self):
+        by_ip = self._by_ip
+        return (by_ip[ip] for ip in self._ips)
+
+    def __contains__(self, ip):
+        return ip in self._by_ip
+
+    @staticmethod
+    def _lookup(index, key):
+        """ Returns the list of IP addresses of key in index """
+        ips = index.get(key)
+        if ips is None:
+            return []
+        return list(ips) if isinstance(ips, dict) else [ips]
+
+    def _unindex(self, ip):
+        mac, hostname = self._keys.pop(ip)
+        for index, key in ((self._by_mac, mac), (self._by_hostname, hostname)):
+            if key:
+                ips = index[key]
+                if not isinstance(ips, dict):
+                    del index[key]
+                else:
+                    del ips[ip]
+                    if len(ips) == 1:
+                        index[key] = next(iter(ips))
+
+    def put(self, host):
+        """
+        Adds a host, or updates the indexes of a host already in the table
+        after its fields have been changed. A host keeps its position
+        """
+        ip = host['ip_addr']
+        self._by_ip[ip] = host
+        mac = host.get('mac_addr', '')
+        hostname = host.get('client_hostname', '')
+        keys = self._keys.get(ip)
+        if keys == (mac, hostname):
+            # Only the order of the updates changes
+            for index, key in ((self._by_mac, mac),
+                               (self._by_hostname, hostname)):
+                ips = index.get(key)
+                if isinstance(ips, dict):
+                    del ips[ip]
+                    ips[ip] = None
+            return
+        if keys is not None:
+            self._unindex(ip)
+        else:
+            self._ips.append(ip)
+        self._keys[ip] = (mac, hostname)
+        for index, key in ((self._by_mac, mac), (self._by_hostname, hostname)):
+            if key:
+                ips = index.get(key)
+                if ips is None:
+                    index[key] = ip
+                elif isinstance(ips, dict):
+                    ips[ip] = None
+                else:
+                    index[key] = collections.OrderedDict(((ips, None),
+                                                          (ip, None)))
+
+    def dump(self):
+        """ Returns the table as builtin types only, see load() """
+        hosts = [self._by_ip[ip] for ip in self._ips]
+        compact = bool(hosts) and isinstance(hosts[0], Host)
+        if compact:
+            hosts = [tuple(getattr(host, attr) for attr in Host.__slots__)
+                     for host in hosts]
+        indexes = [dict((key, list(ips) if isinstance(ips, dict) else ips)
+                        for key, ips in index.iteritems())
+                   for index in (self._by_mac, self._by_hostname)]
+        return (compact, hosts) + tuple(indexes) + (self._keys,)
+
+    @classmethod
+    def load(cls, state):
+        """ Returns a new table from what dump() returned """
+        compact, hosts, by_mac, by_hostname, keys = state
+        table = cls()
+        if compact:
+            table._ips = [row[0] for row in hosts]
+            hosts = [Host(*row) for row in hosts]
+        else:
+            table._ips = [host['ip_addr'] for host in hosts]
+        table._by_ip = dict(zip(table._ips, hosts))
+        for index in (by_mac, by_hostname):
+            for key, ips in index.iteritems():
+                if isinstance(ips, list):
+                    index[key] = collections.OrderedDict.fromkeys(ips)
+        table._by_mac = by_mac
+        table._by_hostname = by_hostname
+        table._keys = keys
+        return table
+
+    def get(self, ip):
+        """ Returns the host with the given IP address or None """
+        return self._by_ip.get(ip)
+
+    def get_by_mac(self, mac):
+        """ Returns the last updated host with the given MAC address or None """
+        ips = self._by_mac.get(mac)
+        if isinstance(ips, dict):
+            ips = next(reversed(ips))
+        return self._by_ip[ips] if ips is not None else None
+
+    def get_by_hostname(self, hostname):
+        """ Returns the list of hosts with the given client hostname """
+        return [self._by_ip[ip]
+                for ip in self._lookup(self._by_hostname, hostname)]
+
+
+class Host(object):
+    """
+    A compact record of an active host, used instead of a dict by
+    DhcpLeasesParser(..., compact=True). The times are kept as seconds since
+    the epoch (NEVER for 'ends never;', None if missing) in the starts_epoch,
+    ends_epoch and cltt_epoch attributes, and only formatted as (localdate,
+    localtime) when read through starts, ends and cltt.
+
+    Hosts can be read like the dicts: host['mac_addr'], host.get('starts'),
+    and as_dict() returns the same dict as the default parser.
+    """
+    __slots__ = ('ip_addr', 'mac_addr', 'client_hostname', 'starts_epoch',
+                 'ends_epoch', 'cltt_epoch')
+    keys = ('ip_addr', 'mac_addr', 'client_hostname', 'starts', 'ends',
+            'cltt')
+
+    def __init__(self, ip_addr, mac_addr='', client_hostname='',
+                 starts_epoch=None, ends_epoch=None, cltt_epoch=None):
+        self.ip_addr = ip_addr
+        self.mac_addr = mac_addr
+        self.client_hostname = client_hostname
+        self.starts_epoch = starts_epoch
+        self.ends_epoch = ends_epoch
+        self.cltt_epoch = cltt_epoch
+
+    @staticmethod
+    def _format(epoch):
+        if epoch is None:
+            return ('', '')
+        elif epoch == NEVER:
+            return ('never', '')
+        return epoch2localtime(epoch)
+
+    @property
+    def starts(self):
+        return self._format(self.starts_epoch)
+
+    @property
+    def ends(self):
+        return self._format(self.ends_epoch)
+
+    @property
+    def cltt(self):
+        return self._format(self.cltt_epoch)
+
+    def __getitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.keys else default
+
+    def as_dict(self):
+        """ Returns the host as a dict """
+        return dict((key, getattr(self, key)) for key in self.keys)
+
+    def __eq__(self, other):
+        if isinstance(other, Host):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Host(%r)" % self.as_dict()
+
+
+class TimeIndex(object):
+    """
+    An index of the lease times of the active hosts, by IP address: when
+    the lease starts and ends, and when it last changed (the latest of its
+    starts and cltt times), in seconds since the epoch.
+
+    The queries run in O(log n + k) for k results, over sorted lists (with
+    bisect) and a centered interval tree, which are built again on the
+    first query after the times changed.
+    """
+    def __init__(self, times=None):
+        # IP address -> (starts, ends, changed)
+        self._times = times or {}
+        self._ends = None
+        self._changes = None
+        self._tree = None
+
+    def __len__(self):
+        return len(self._times)
+
+    def put(self, ip, starts, ends, changed):
+        """
+        Sets the times of an IP address. starts and changed can be None if
+        unknown, ends can be None or NEVER if the lease never ends
+        """
+        self._times[ip] = (starts, NEVER if ends is None else ends, changed)
+        self._ends = self._changes = self._tree = None
+
+    def dump(self):
+        """ Returns the index as builtin types, see __init__() """
+        return self._times
+
+    def _build(self):
+        self._ends = sorted((ends, ip)
+                            for ip, (starts, ends, changed)
+                            in self._times.iteritems())
+        self._changes = sorted((changed, ip)
+                               for ip, (starts, ends, changed)
+                               in self._times.iteritems()
+                               if changed is not None)
+        self._tree = self._build_tree(
+            [(starts, ends, ip)
+             for ip, (starts, ends, changed) in self._times.iteritems()
+             if starts is not None and starts < ends])
+
+    @classmethod
+    def _build_tree(cls, intervals):
+        """
+        Returns the interval tree node of the [starts, ends) intervals:
+        (center, intervals holding center sorted by starts, the same sorted
+        by decreasing ends, left node, right node), or None
+        """
+        if not intervals:
+            return None
+        starts = sorted(iv[0] for iv in intervals)
+        center = starts[len(starts) // 2]
+        left, here, right = [], [], []
+        for iv in intervals:
+            if iv[1] <= center:
+                left.append(iv)
+            elif iv[0] > center:
+                right.append(iv)
+            else:
+                here.append(iv)
+        return (center, sorted(here),
+                sorted(here, key=lambda iv: iv[1], reverse=True),
+                cls._build_tree(left), cls._build_tree(right))
+
+    def active_at(self, t):
+        """ Returns the IP addresses whose lease holds the time t """
+        if self._tree is None:
+            self._build()
+        ips = []
+        node = self._tree
+        while node is not None:
+            center, by_starts, by_ends, left, right = node
+            if t < center:
+                for starts, ends, ip in by_starts:
+                    if starts > t:
+                        break
+                    ips.append(ip)
+                node = left
+            else:
+                for starts, ends, ip in by_ends:
+                    if ends <= t:
+                        break
+                    ips.append(ip)
+                node = right
+        return ips
+
+    def ending_between(self, first, last):
+        """ Returns the IP addresses whose lease ends in [first, last) """
+        if self._ends is None:
+            self._build()
+        start = bisect.bisect_left(self._ends, (first,))
+        stop = bisect.bisect_left(self._ends, (last,))
+        return [ip for ends, ip in self._ends[start:stop]]
+
+    def changed_since(self, t):
+        """ Returns the IP addresses whose lease changed at t or after """
+        if self._changes is None:
+            self._build()
+        start = bisect.bisect_left(self._changes, (t,))
+        return [ip for changed, ip in self._changes[start:]]
+
+
+LeaseEvent = collections.namedtuple('LeaseEvent', 'starts ends ip_addr '
+                                    'mac_addr binding_state')
+
+
+class LeaseHistory(object):
+    """
+    The last lease entries of each IP address and of each MAC address, as
+    (starts, ends, ip_addr, mac_addr, binding_state) tuples, the times being
+    in seconds since the epoch like in TimeIndex. At most depth entries are
+    kept per address, the oldest ones being dropped first, so that the
+    memory stays bounded whatever the length of the file.
+
+    The entries are kept in short lists rather than deques, which take
+    several times more memory for a few items.
+    """
+    def __init__(self, depth, by_ip=None, by_mac=None):
+        self.depth = depth
+        self._by_ip = by_ip or {}
+        self._by_mac = by_mac or {}
+
+    def __len__(self):
+        return len(self._by_ip)
+
+    def add(self, event):
+        """ Adds an entry tuple (see LeaseEvent) """
+        for index, key in ((self._by_ip, event[2]), (self._by_mac, event[3])):
+            if key:
+                events = index.get(key)
+                if events is None:
+                    index[key] = [event]
+                else:
+                    events.append(event)
+                    if len(events) > self.depth:
+                        del events[0]
+
+    def dump(self):
+        """ Returns the history as builtin types, see __init__() """
+        return (self.depth, self._by_ip, self._by_mac)
+
+    def by_ip(self, ip):
+        """ Returns the LeaseEvents of an IP address, oldest first """
+        return [LeaseEvent(*event) for event in self._by_ip.get(ip, ())]
+
+    def by_mac(self, mac):
+        """ Returns the LeaseEvents of a MAC address, oldest first """
+        return [LeaseEvent(*event) for event in self._by_mac.get(mac, ())]
+
 
 class DhcpLeasesParser(object):
     """ The parser class based on PyParsing to parse a dhcpd.leases file """
-    def __init__(self, leases_filename):
+    # What is saved in a snapshot file
+    snapshot_attrs = ('ips', 'dups', 'count_tot', 'count_parsed', 'hosts',
+                      'times', 'history', 'offset', 'inode', '_tail')
+
+    def __init__(self, leases_filename, engine='pyparsing', compact=False,
+                 snapshot=None, jobs=1, history=0):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine: %s" % engine)
+        self.engine = engine
+        # Number of processes parsing the file, see parse()
+        self.jobs = jobs
+        # Keep the hosts as Host records instead of dicts
+        self.compact = compact
         self.leases_filename = leases_filename
-        self.leases = ""
+        # Path of the snapshot file, see parse()
+        if snapshot is True:
+            snapshot = leases_filename + SNAPSHOT_SUFFIX
+        self.snapshot = snapshot
+        # The _file_key() of the parsed results, and of the saved ones
+        self._parsed_key = None
+        self._snapshot_key = None
         self.ips = set()
         self.count_tot = 0
         self.count_parsed = 0
-        self.hosts = []
+        self.hosts = HostTable()
+        self.times = TimeIndex()
+        # The last history entries kept by address, none if 0
+        self.history_depth = history
+        self.history = LeaseHistory(history) if history else None
         self.lease_def = self._setup()
         self.extras = ('starts', 'ends', 'cltt')
         # Keep track of duplicate entries that canbe found in the leases file
         # as this might be an indicator that a DUT is behaving strangely
         self.dups = set()
+        # Where the next incremental parse starts, and what must still be
+        # found there: the (device, inode) of the file and its last bytes
+        self.offset = 0
+        self.inode = None
+        self._tail = ''
 
     def _setup(self):
         """ Define the grammar used in the leases file """
@@ -62,11 +867,9 @@ class DhcpLeasesParser(object):
 
         def _utc2localtime(tokens):
             """ Converts UTC date and time to local time """
-            utctime = datetime.datetime.strptime("%(date)s %(time)s" % tokens,
-                                                 "%Y/%m/%d %H:%M:%S")
-            localtime = utctime - datetime.timedelta(0, time.timezone, 0)
             tokens["utcdate"], tokens["utctime"] = tokens["date"], tokens["time"]
-            tokens["localdate"], tokens["localtime"] = str(localtime).split()
+            tokens["localdate"], tokens["localtime"] = utc2localtime(
+                tokens["date"], tokens["time"])
             del tokens["date"]
             del tokens["time"]
         dateref.setParseAction(_utc2localtime)
@@ -84,7 +887,9 @@ class DhcpLeasesParser(object):
         cltt = Literal("cltt") + dateref + semi
         hdw = (Literal("hardware") + hwtype("type") +
               macaddr("mac") + semi)
-        uid = Literal("uid") + QuotedString('"', escChar='\\') + semi
+        uid = Literal("uid") + QuotedString(
+            '"', escChar='\\', unquoteResults=False).setParseAction(
+                lambda toks: unescape(toks[0][1:-1])) + semi
 
         bind_state = Literal('active') \
             | Literal('free') \
@@ -106,79 +911,532 @@ class DhcpLeasesParser(object):
         leasedef.ignore(comment)
         return leasedef
 
-    def parse(self):
-        """ Open, read and parse the contents of the leases file """
+    def _reset(self):
+        """ Forgets everything parsed so far """
+        self.ips = set()
+        self.dups = set()
+        self.count_tot = 0
+        self.count_parsed = 0
+        self.hosts = HostTable()
+        self.times = TimeIndex()
+        if self.history is not None:
+            self.history = LeaseHistory(self.history_depth)
+        self.offset = 0
+        self.inode = None
+        self._tail = ''
+        self._parsed_key = None
+
+    def _appended(self, leasesf, st):
+        """
+        Returns True if the file has only been appended to since the
+        previous parse, i.e. it is the same inode, it is not shorter and the
+        bytes before the saved offset did not change
+        """
+        if (self.inode != (st.st_dev, st.st_ino) or
+                st.st_size < self.offset):
+            return False
+        leasesf.seek(self.offset - len(self._tail))
+        return leasesf.read(len(self._tail)) == self._tail
+
+    def parse(self, incremental=False):
+        """
+        Open, read and parse the contents of the leases file.
+
+        dhcpd only appends lease blocks to the file, and rewrites it from
+        time to time. With incremental=True only the complete blocks
+        appended since the previous call are parsed, unless the file has
+        been rewritten, in which case it is parsed again from scratch. An
+        incomplete block at the end of the file is left for the next call.
+
+        With jobs > 1, big files are split in ranges of lease blocks, which
+        are parsed in a pool of processes. The results are the same.
+
+        If the parser has a snapshot file, the first call starts from the
+        results saved there when they are still valid for the file, and
+        only parses what was appended since. The snapshot is saved again
+        after a full parse, and after that first call if it parsed new
+        blocks, so that the next process starts from there. Saving it costs
+        as much as the whole table, so after the following incremental
+        calls it is up to the caller to call save_snapshot() from time to
+        time (e.g. on exit).
+
+        If the parse fails (e.g. on an invalid date), everything is
+        forgotten, so that the next call parses the file from scratch
+        instead of counting again what was added before the error.
+        """
+        first = self.snapshot and self.inode is None
+        if first:
+            incremental = self._load_snapshot()
+        offset = self.offset
+        try:
+            full = self._parse_file(incremental)
+        except Exception:
+            self._reset()
+            raise
+        if full or (first and self.offset != offset):
+            self.save_snapshot()
+
+    def _parse_file(self, incremental):
+        """
+        Parses the leases file for parse(), returns True if it was parsed
+        from scratch
+        """
         with open(self.leases_filename, 'rb') as leasesf:
-            leases_ls = leasesf.readlines()
-        self.leases = ''.join(leases_ls)
+            st = os.fstat(leasesf.fileno())
+            full = not incremental or not self._appended(leasesf, st)
+            if full:
+                self._reset()
+            self.inode = (st.st_dev, st.st_ino)
+            buf = None
+            if st.st_size > self.offset:
+                # The file is not read in memory, only mapped: the counts
+                # and the lease blocks are taken from it in one pass
+                buf = mmap.mmap(leasesf.fileno(), st.st_size,
+                                access=mmap.ACCESS_READ)
+        if buf is not None:
+            try:
+                end = complete_blocks_end(buf, self.offset)
+                ranges = []
+                if self.jobs > 1:
+                    # A few ranges per process, to even out their work
+                    ranges = split_ranges(buf, self.offset, end,
+                                          self.jobs * 4)
+                if len(ranges) > 1:
+                    self._parse_parallel(ranges)
+                else:
+                    for lease in self._iter_leases(buf, self.offset, end):
+                        self._add_lease(lease)
+                if end > self.offset:
+                    self._tail = buf[max(end - TAIL_SIZE, 0):end]
+                    self.offset = end
+            finally:
+                buf.close()
+        self._parsed_key = self._file_key(st)
+        return full
 
-        self.count_tot = 0
-        for line in leases_ls:
-            if not line.startswith('#'):
-                if re.findall(r'lease\s+' + IPV4ADDR_RE + '\s+', line, re.DOTALL):
-                    ip_addr = re.search(IPV4ADDR_RE, line).group(0)
-                    self.count_tot += 1
-                    if ip_addr in self.ips:
-                        self.dups.add(ip_addr)
-                    self.ips.add(ip_addr)
+    def _parse_parallel(self, ranges):
+        """
+        Parses the byte ranges of the file in a pool of self.jobs processes,
+        and merges their results in file order, as if parsed in one go
+        """
+        tasks = [(self.leases_filename, self.inode, self.engine, self.compact,
+                  self.history is not None, start, end)
+                 for start, end in ranges]
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            for entries, records, events in pool.imap(parse_range, tasks):
+                for ip_addr in entries:
+                    self._add_entry(ip_addr)
+                for record in records:
+                    self._add_record(record)
+                for event in events:
+                    self.history.add(event)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
-        self.count_parsed = 0
-        for lease in self.lease_def.searchString(self.leases):
-            do_append = True
-            #print lease.dump()
-            # Each lease must have an IP address
-            if ('ipaddress' not in lease or
-               'binding' not in lease or
-               lease['binding'] != 'active'):
-                continue
-            # There can be existing hosts with same ipaddress but other
-            # lease attributes. The implicit behaviour here is that later
-            # leases for the same IP address will supersede earlier ones
-            host = self.get_host_by_ip(lease.ipaddress)
+    def _file_key(self, st):
+        """ What identifies the state of the leases file in a snapshot """
+        return (os.path.abspath(self.leases_filename), st.st_dev, st.st_ino,
+                st.st_size, st.st_mtime, self.compact, self.history_depth)
+
+    def _load_snapshot(self):
+        """
+        Restores the results saved in the snapshot file, if they are still
+        valid for the leases file. Returns True if they were restored
+        """
+        # None of the loaded objects can be garbage, so there is no need to
+        # run the cyclic garbage collector again and again while loading
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._restore_snapshot()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _restore_snapshot(self):
+        try:
+            with open(self.snapshot, 'rb') as snapf:
+                snap = marshal.loads(snapf.read())
+            st = os.stat(self.leases_filename)
+        except (IOError, OSError, EOFError, ValueError, TypeError) as err:
+            logger.debug("Cannot load snapshot %s: %s", self.snapshot, err)
+            return False
+        if (not isinstance(snap, dict) or
+                snap.get('version') != SNAPSHOT_VERSION):
+            return False
+        key = snap['key']
+        path, size, mtime = key[0], key[3], key[4]
+        if path != os.path.abspath(self.leases_filename) or \
+                key[5:] != (self.compact, self.history_depth):
+            return False
+        if st.st_size == size and st.st_mtime != mtime:
+            # Rewritten in place. parse() checks the other cases
+            return False
+        for attr in self.snapshot_attrs:
+            setattr(self, attr, snap[attr])
+        self.hosts = HostTable.load(self.hosts)
+        self.times = TimeIndex(self.times)
+        if self.history is not None:
+            self.history = LeaseHistory(*self.history)
+        self._parsed_key = self._snapshot_key = key
+        return True
+
+    def save_snapshot(self):
+        """
+        Saves the results in the snapshot file, if the parser has one and
+        they changed since they were last saved or restored
+        """
+        if (self.snapshot and self._parsed_key is not None and
+                self._parsed_key != self._snapshot_key):
+            self._save_snapshot(self._parsed_key)
+
+    def _save_snapshot(self, key):
+        """ Saves the results in the snapshot file, which is replaced """
+        snap = dict((attr, getattr(self, attr))
+                    for attr in self.snapshot_attrs)
+        snap['hosts'] = self.hosts.dump()
+        snap['times'] = self.times.dump()
+        if self.history is not None:
+            snap['history'] = self.history.dump()
+        snap['version'] = SNAPSHOT_VERSION
+        snap['key'] = key
+        tmp = "%s.%d.tmp" % (self.snapshot, os.getpid())
+        try:
+            # marshal is several times faster than pickle to load
+            with open(tmp, 'wb') as snapf:
+                marshal.dump(snap, snapf)
+            os.rename(tmp, self.snapshot)
+        except (IOError, OSError) as err:
+            logger.warning("Cannot save snapshot %s: %s", self.snapshot, err)
+            return
+        self._snapshot_key = key
+
+    def refresh(self):
+        """ Parses what has been appended to the file since the last call """
+        self.parse(incremental=True)
+
+    def _add_entry(self, ip_addr):
+        """ Counts a lease entry and tells if it is a duplicate """
+        self.count_tot += 1
+        if ip_addr in self.ips:
+            self.dups.add(ip_addr)
+        self.ips.add(ip_addr)
+
+    @staticmethod
+    def _count_entries(blocks, add_entry):
+        """
+        Passes the blocks of lines through, calling add_entry() with the IP
+        address of each lease entry they hold
+        """
+        for block in blocks:
+            for found in lease_entry_re.finditer(block):
+                add_entry(ipv4addr_re.search(found.group(0)).group(0))
+            yield block
+
+    def _iter_leases(self, buf, start, end, add_entry=None):
+        """
+        Yields the lease blocks of buf[start:end] found by the selected
+        engine, and counts the lease entries (with add_entry() if given)
+        """
+        blocks = self._count_entries(iter_blocks(buf, start, end),
+                                     add_entry or self._add_entry)
+        if self.engine == 'tokenizer':
+            for lease in LeasesTokenizer().scan(blocks):
+                yield lease
+        else:
+            for block in blocks:
+                pass
+            # PyParsing needs the whole text
+            for lease, first, last in self.lease_def.scanString(
+                    buf[start:end]):
+                yield lease
+
+    def _add_lease(self, lease):
+        """
+        Adds or updates the host of an active lease. The lease can be a
+        PyParsing result or a dict from LeasesTokenizer
+        """
+        if self.history is not None:
+            self.history.add(self._event(lease))
+        record = self._record(lease)
+        if record is not None:
+            self._add_record(record)
+
+    @classmethod
+    def _event(cls, lease):
+        """ Returns the LeaseHistory entry tuple of a lease """
+        if 'hardware' in lease and 'mac' in lease['hardware']:
+            mac = intern(lease['hardware']['mac'])
+        else:
+            mac = ''
+        return (cls._epoch(lease, 'starts'), cls._epoch(lease, 'ends'),
+                lease['ipaddress'], mac, intern(lease.get('binding', '')))
+
+    def _record(self, lease):
+        """
+        Returns what _add_record() needs of an active lease (as builtin
+        types, so that it can come from another process), or None
+        """
+        #print lease.dump()
+        # Each lease must have an IP address
+        if ('ipaddress' not in lease or
+           'binding' not in lease or
+           lease['binding'] != 'active'):
+            return None
+        # If a MAC address has been found, save it
+        if 'hardware' in lease and 'mac' in lease['hardware']:
+            mac = lease['hardware']['mac']
+        else:
+            mac = ''
+        # If a hostname for the client is available, save it
+        if 'client-hostname' in lease:
+            hostname = lease['client-hostname']
+        else:
+            hostname = ''
+        # Add some extra paramaters, as (localdate, localtime) for the dicts
+        epochs = tuple(self._epoch(lease, el) for el in self.extras)
+        dates = None
+        if not self.compact:
+            dates = tuple(self._date(lease, el) for el in self.extras)
+        return (lease['ipaddress'], mac, hostname, epochs, dates)
+
+    @staticmethod
+    def _epoch(lease, el):
+        """
+        Returns the time of a lease statement in seconds since the epoch,
+        NEVER for 'never' and None if the lease does not have it
+        """
+        if el not in lease:
+            return None
+        elif isinstance(lease[el], basestring):
+            return NEVER
+        return utc2epoch(lease[el]['utcdate'], lease[el]['utctime'])
+
+    @staticmethod
+    def _date(lease, el):
+        """ Returns the (localdate, localtime) of a lease statement """
+        if el not in lease:
+            return ('', '')
+        elif isinstance(lease[el], basestring):
+            # 'ends never;'
+            return (lease[el], '')
+        return (lease[el]['localdate'], lease[el]['localtime'])
+
+    def _add_record(self, record):
+        """ Adds or updates a host with a record from _record() """
+        ip, mac, hostname, epochs, dates = record
+        starts, ends, cltt = epochs
+        self.times.put(ip, starts, ends, max(starts, cltt))
+        # There can be existing hosts with same ipaddress but other
+        # lease attributes. The implicit behaviour here is that later
+        # leases for the same IP address will supersede earlier ones
+        host = self.hosts.get(ip)
+        if self.compact:
             if host is None:
-                host = {'ip_addr': lease.ipaddress}
-            else:
-                # if the host entry already exists, just update
-                do_append = False
-            # If a MAC address has been found, save it in dict
-            if 'hardware' in lease and 'mac' in lease['hardware']:
-                host['mac_addr'] = lease.hardware.mac
-            else:
-                host['mac_addr'] = ''
-            # If a hostname for the client is available, save it in dict
-            if 'client-hostname' in lease:
-                host['client_hostname'] = lease['client-hostname']
-            else:
-                host['client_hostname'] = ''
-            # Add some extra paramaters in dict
-            for el in self.extras:
-                if el in lease:
-                    host[el] = (lease[el]['localdate'],
-                                lease[el]['localtime'])
-                else:
-                    host[el] = ('', '')
-            if do_append:
-                self.hosts.append(host)
-            self.count_parsed += 1
+                host = Host(ip)
+            host.mac_addr = intern(mac)
+            host.client_hostname = intern(hostname)
+            host.starts_epoch, host.ends_epoch, host.cltt_epoch = epochs
+        else:
+            if host is None:
+                host = {'ip_addr': ip}
+            host['mac_addr'] = mac
+            host['client_hostname'] = hostname
+            for el, date in zip(self.extras, dates):
+                host[el] = date
+        self.hosts.put(host)
+        self.count_parsed += 1
 
     def get_host_by_ip(self, ip):
-        for host in self.hosts:
-            if host['ip_addr'] == ip:
-                return host
-        return None
+        """ Returns the active host with the given IP address or None """
+        return self.hosts.get(ip)
+
+    def get_host_by_mac(self, mac):
+        """
+        Returns the active host with the given MAC address (the last updated
+        one if there are several) or None
+        """
+        return self.hosts.get_by_mac(mac)
+
+    def get_hosts_by_hostname(self, hostname):
+        """ Returns the list of active hosts with the given client hostname """
+        return self.hosts.get_by_hostname(hostname)
+
+    def iter_leases(self, active_only=False):
+        """
+        Yields a dict of FIELDS for each lease block of the file (only the
+        active ones if active_only is True), in file order and as soon as
+        it is parsed. Nothing is kept, and with the tokenizer engine the
+        file is read block by block, so the memory used does not depend on
+        its size. The times are local 'YYYY-MM-DD HH:MM:SS' strings, 'never'
+        or ''
+        """
+        with open(self.leases_filename, 'rb') as leasesf:
+            if self.engine == 'tokenizer':
+                leases = LeasesTokenizer().scan(read_blocks(leasesf))
+            else:
+                leases = self.lease_def.scanString(leasesf.read())
+                leases = (lease for lease, first, last in leases)
+            for lease in leases:
+                if active_only and lease.get('binding') != 'active':
+                    continue
+                yield self._row(lease)
+
+    def _row(self, lease):
+        """ Returns the dict of FIELDS of a lease """
+        hardware = lease['hardware'] if 'hardware' in lease else {}
+        row = {'ip_addr': lease['ipaddress'],
+               'binding_state': lease.get('binding', ''),
+               'next_binding_state': (lease['next'][-1] if 'next' in lease
+                                      else ''),
+               'mac_addr': hardware.get('mac', ''),
+               'hardware_type': hardware.get('type', ''),
+               'client_hostname': lease.get('client-hostname', ''),
+               # The bytes of the uid, which is often binary
+               'uid': ':'.join('%02x' % ord(c) for c in lease.get('uid', ''))}
+        for el in LeasesTokenizer.dates:
+            row[el] = ' '.join(self._date(lease, el)).strip()
+        return row
+
+    def get_history_by_ip(self, ip):
+        """
+        Returns the last LeaseEvents (starts, ends, ip_addr, mac_addr,
+        binding_state) of an IP address, oldest first, if the parser keeps a
+        history
+        """
+        return self.history.by_ip(ip) if self.history is not None else []
+
+    def get_history_by_mac(self, mac):
+        """ Like get_history_by_ip(), for a MAC address """
+        return self.history.by_mac(mac) if self.history is not None else []
+
+    def active_at(self, t=None):
+        """
+        Returns the active hosts whose lease holds the time t (seconds since
+        the epoch, now by default), in no particular order. Hosts without
+        starts time are left out
+        """
+        if t is None:
+            t = time.time()
+        return [self.hosts.get(ip) for ip in self.times.active_at(t)]
+
+    def expiring_within(self, seconds, now=None):
+        """
+        Returns the active hosts whose lease ends in the given number of
+        seconds from now, the first ones to expire first
+        """
+        if now is None:
+            now = time.time()
+        return [self.hosts.get(ip)
+                for ip in self.times.ending_between(now, now + seconds)]
+
+    def changed_since(self, t):
+        """
+        Returns the active hosts whose lease started or had a client
+        transaction at t (seconds since the epoch) or after, the oldest
+        change first
+        """
+        return [self.hosts.get(ip) for ip in self.times.changed_since(t)]
 
     def get_hosts(self):
         """ Returns a list of active leases/hosts """
-        return self.hosts
+        return list(self.hosts)
 
     def get_leases(self):
         """ Returns a list of all lease entries """
         return self.ips
 
-if __name__ == "__main__":
-    import sys
+def write_rows(rows, out, fmt, fields):
+    """
+    Writes the rows (dicts) to the out stream as they come, in the jsonl,
+    csv or tsv format, with the given fields only. The stream is flushed
+    every FLUSH_ROWS rows. Returns the number of rows written
+    """
+    if fmt == 'jsonl':
+        def write(row):
+            out.write(json.dumps(collections.OrderedDict(
+                (field, row[field].decode('utf-8', 'replace'))
+                for field in fields)) + '\n')
+    else:
+        writer = csv.writer(out, delimiter='\t' if fmt == 'tsv' else ',',
+                            lineterminator='\n')
+        writer.writerow(fields)
+
+        def write(row):
+            writer.writerow([row[field] for field in fields])
+    count = 0
+    for row in rows:
+        write(row)
+        count += 1
+        if count % FLUSH_ROWS == 0:
+            out.flush()
+    out.flush()
+    return count
+
+def usage(msg=None):
+    s = None
+    err = 0
+    if msg and msg.startswith("Error:"):
+        s = sys.stderr
+        err = 1
+    else:
+        s = sys.stdout
+    if msg and s:
+        s.write(msg + "\n")
+    sys.stdout.write(usage_msg)
+    return err
+
+def main(args=None):
+    """ The main function of this script
+    returns 0 on success or 1 otherwise
+    """
+    engine = None
+    fmt = None
+    fields = DEFAULT_FIELDS
+    active_only = False
+
+    try:
+        opts, remainder = getopt.getopt(
+            sys.argv[1:] if args is None else args, "he:f:F:a",
+            ['help', 'engine=', 'format=', 'fields=', 'active-only'])
+    except getopt.GetoptError, err:
+        return usage("Error: %s" % err)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            return usage()
+        elif o in ('-e', '--engine'):
+            if a not in ENGINES:
+                return usage("Error: unknown engine '%s'" % a)
+            engine = a
+        elif o in ('-f', '--format'):
+            if a not in FORMATS:
+                return usage("Error: unknown format '%s'" % a)
+            fmt = a
+        elif o in ('-F', '--fields'):
+            fields = tuple(a.split(','))
+            for field in fields:
+                if field not in FIELDS:
+                    return usage("Error: unknown field '%s'" % field)
+        elif o in ('-a', '--active-only'):
+            active_only = True
+
+    if len(remainder) != 1:
+        return usage("Error: " + myself + " needs one leases file")
+
+    if engine is None:
+        # The tokenizer reads the file block by block for --format
+        engine = 'tokenizer' if fmt else 'pyparsing'
     # Parse the given dhcpd.leases file for active leases
-    lease_parser = DhcpLeasesParser(sys.argv[1])
+    lease_parser = DhcpLeasesParser(remainder[0], engine=engine)
+    if fmt:
+        # One row per lease block, written as soon as it is parsed
+        write_rows(lease_parser.iter_leases(active_only), sys.stdout, fmt,
+                   fields)
+        return 0
     lease_parser.parse()
     # Returns the list of active hosts/leases
     res = lease_parser.get_hosts()
@@ -188,4 +1446,9 @@ if __name__ == "__main__":
     print "Found %d unique leases" % len(res)
     print "duplicates:"
     print lease_parser.dups
+    return 0
 
+if __name__ == "__main__":
+    # Die quietly when the reader goes away, e.g. when piped into head
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    sys.exit(main())
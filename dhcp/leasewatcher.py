@@ -0,0 +1,477 @@
+#!/usr/bin/python
+"""
+LeaseService: a long-running service which keeps the active hosts of a
+dhcpd.leases file in memory and answers lookups over a Unix domain socket,
+so that the clients do not have to parse the file themselves.
+
+The file is watched with inotify (through ctypes, on Linux) or, when it is
+not available, by polling its stat() every few seconds. Appended leases are
+parsed incrementally, and a rewritten file is parsed again from scratch.
+
+* Usage:
+  % ./leasewatcher.py -s /run/leases.sock /var/lib/dhcp/dhcpd.leases
+
+* Protocol: one JSON object per line, with one of the "ip", "mac" or
+  "hostname" keys, gets one JSON object per line back:
+  % echo '{"mac": "00:11:22:33:44:55"}' | socat - UNIX-CONNECT:/run/leases.sock
+  {"hosts": [{"ip_addr": "192.168.1.10", "mac_addr": "00:11:22:33:44:55", ...}]}
+  % echo '{"stats": true}' | socat - UNIX-CONNECT:/run/leases.sock
+  {"count_tot": 5, "count_parsed": 3, "hosts": 2, "dups": 1}
+
+  Errors are returned as {"error": "..."}. query() does the same in Python.
+
+Copyright 2015 coruja
+SPDX-License-Identifier: GPL-2.0
+"""
+import sys
+import os
+import errno
+import getopt
+import json
+import logging
+import select
+import signal
+import socket
+import stat
+import struct
+import time
+
+from dhcp import DhcpLeasesParser, ENGINES
+
+logger = logging.getLogger(__name__)
+
+myself = os.path.basename(sys.argv[0])
+
+usage_msg = 'Usage: ' + myself + ' [options...] <dhcpd.leases>' + """
+Options:
+ -h/--help                This help text
+ -s/--socket <path>       Path of the Unix socket (default: leases file.sock)
+ -e/--engine <name>       Parsing engine: pyparsing or tokenizer (default)
+ -i/--interval <seconds>  Stat polling interval, when inotify is not
+                          available (default 2)
+ -p/--poll                Poll the file even if inotify is available
+ --snapshot               Keep a snapshot of the parsed leases next to the
+                          leases file, for fast restarts. It is saved every
+                          few minutes and on exit
+"""
+
+# Default polling interval in seconds
+POLL_INTERVAL = 2.0
+# How often the snapshot of the parser (if any) is saved, in seconds
+SNAPSHOT_INTERVAL = 300.0
+# A client sending a longer line than this is disconnected
+MAX_LINE = 64 * 1024
+# The requests of a client are not read any more while it has this many
+# bytes of answers waiting to be sent
+MAX_OUTPUT = 1024 * 1024
+
+
+class StatWatcher(object):
+    """ Tells when a file changed by polling its stat() """
+    def __init__(self, path, interval=POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._key = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def fileno(self):
+        """ There is nothing to wait for, the file must be polled """
+        return None
+
+    def changed(self):
+        """ Returns True if the file changed since the previous call """
+        key = self._stat()
+        if key == self._key:
+            return False
+        self._key = key
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Tells when a file changed with inotify. The directory of the file is
+    watched, so that the file can be replaced (as dhcpd does when it
+    rewrites it). Raises OSError if inotify is not available
+    """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+        self.interval = None
+        self.name = os.path.basename(path)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO |
+                self.IN_CREATE)
+        dirname = os.path.dirname(os.path.abspath(path))
+        if libc.inotify_add_watch(self.fd, dirname, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch failed on %s" % dirname)
+
+    def fileno(self):
+        return self.fd
+
+    def changed(self):
+        """ Reads the pending events, returns True if one is for the file """
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    return found
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = self.event_header.unpack_from(data,
+                                                                       pos)
+                pos += self.event_header.size
+                name = data[pos:pos + size].rstrip('\0')
+                pos += size
+                if name == self.name or mask & self.IN_Q_OVERFLOW:
+                    found = True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(path, interval=POLL_INTERVAL, poll=False):
+    """ Returns an InotifyWatcher, or a StatWatcher if not possible """
+    if not poll:
+        try:
+            return InotifyWatcher(path)
+        except OSError as err:
+            logger.info("Polling %s: %s", path, err)
+    return StatWatcher(path, interval)
+
+
+def decode_host(host):
+    """
+    Returns a host (a dict or a Host) as a dict which can be dumped to JSON:
+    the leases file is not always valid UTF-8
+    """
+    if not isinstance(host, dict):
+        host = host.as_dict()
+    return dict((key, value.decode('utf-8', 'replace')
+                 if isinstance(value, str) else value)
+                for key, value in host.items())
+
+
+class LeaseService(object):
+    """
+    Serves the lookups of a DhcpLeasesParser over a Unix domain socket, and
+    refreshes the parser when the watcher tells the leases file changed.
+    Everything runs in one thread, around one poll() loop. Raises OSError
+    if something else than a socket exists at socket_path
+    """
+    def __init__(self, parser, socket_path, watcher):
+        self.parser = parser
+        self.socket_path = socket_path
+        self.watcher = watcher
+        self.stopped = False
+        # fd -> [socket, input buffer, output buffer]
+        self._clients = {}
+        self._poller = select.poll()
+        self._next_poll = 0
+        self._next_snapshot = time.time() + SNAPSHOT_INTERVAL
+        if os.path.lexists(socket_path):
+            # Left by a previous run, but never replace another file
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise OSError(errno.EEXIST, "%s exists and is not a socket" %
+                              socket_path)
+            os.remove(socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(socket_path)
+        self._server.listen(128)
+        self._server.setblocking(False)
+        self._poller.register(self._server, select.POLLIN)
+        if watcher.fileno() is not None:
+            self._poller.register(watcher.fileno(), select.POLLIN)
+        self.refresh()
+
+    def refresh(self):
+        """ Parses what changed in the leases file """
+        try:
+            self.parser.refresh()
+        except (IOError, OSError, ValueError) as err:
+            # E.g. the file is being replaced: wait for the next change
+            logger.warning("Cannot parse %s: %s", self.parser.leases_filename,
+                           err)
+
+    def answer(self, request):
+        """ Returns the answer (a dict) to a request (a JSON string) """
+        try:
+            request = json.loads(request)
+        except ValueError as err:
+            return {'error': "invalid JSON: %s" % err}
+        if not isinstance(request, dict):
+            return {'error': "the request must be a JSON object"}
+        parser = self.parser
+        for key in ('ip', 'mac', 'hostname'):
+            if key in request:
+                if not isinstance(request[key], basestring):
+                    return {'error': "%s must be a string" % key}
+                # The leases are indexed by their raw bytes
+                request[key] = request[key].encode('utf-8')
+        if 'ip' in request:
+            hosts = [parser.get_host_by_ip(request['ip'])]
+        elif 'mac' in request:
+            hosts = [parser.get_host_by_mac(request['mac'])]
+        elif 'hostname' in request:
+            hosts = parser.get_hosts_by_hostname(request['hostname'])
+        elif 'stats' in request:
+            return {'count_tot': parser.count_tot,
+                    'count_parsed': parser.count_parsed,
+                    'hosts': len(parser.hosts), 'dups': len(parser.dups)}
+        else:
+            return {'error': "unknown request, use ip, mac or hostname"}
+        return {'hosts': [decode_host(host) for host in hosts
+                          if host is not None]}
+
+    def _answer_line(self, line):
+        """ Returns the JSON answer to a request line, errors included """
+        try:
+            return json.dumps(self.answer(line))
+        except Exception as err:
+            # A bad request or lease must not stop the other clients
+            logger.exception("Cannot answer %r", line[:100])
+            return json.dumps({'error': "internal error: %s" % err})
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self._server.accept()
+            except socket.error as err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            conn.setblocking(False)
+            self._clients[conn.fileno()] = [conn, '', '']
+            self._poller.register(conn, select.POLLIN)
+
+    def _close(self, fd):
+        conn = self._clients.pop(fd)[0]
+        self._poller.unregister(fd)
+        conn.close()
+
+    def _read(self, fd):
+        client = self._clients[fd]
+        try:
+            data = client[0].recv(64 * 1024)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._close(fd)
+            return
+        client[1] += data
+        self._serve(fd)
+
+    def _serve(self, fd):
+        """
+        Answers the complete request lines of a client and sends what it can
+        of the answers. The requests are not read while MAX_OUTPUT bytes of
+        answers wait for the client to read them
+        """
+        client = self._clients[fd]
+        while True:
+            lines = client[1].split('\n')
+            partial = lines.pop()
+            if len(partial) > MAX_LINE:
+                self._close(fd)
+                return
+            served = 0
+            for line in lines:
+                if len(client[2]) >= MAX_OUTPUT:
+                    break
+                served += 1
+                if line.strip():
+                    client[2] += self._answer_line(line) + '\n'
+            if served:
+                client[1] = '\n'.join(lines[served:] + [partial])
+            if not client[2]:
+                break
+            try:
+                sent = client[0].send(client[2])
+            except socket.error as err:
+                if err.errno not in (errno.EAGAIN, errno.EINTR):
+                    self._close(fd)
+                    return
+                sent = 0
+            client[2] = client[2][sent:]
+            if not sent or served == len(lines):
+                break
+        # Only wait for the client to be writable when it is late
+        events = select.POLLIN if len(client[2]) < MAX_OUTPUT else 0
+        self._poller.modify(fd, events | (select.POLLOUT if client[2] else 0))
+
+    def handle_events(self, timeout=None):
+        """
+        Waits for at most timeout seconds (and for at most the polling
+        interval of the watcher), then serves the clients and refreshes the
+        parser if needed
+        """
+        if self.watcher.fileno() is None:
+            wait = max(self._next_poll - time.time(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+        try:
+            events = self._poller.poll(None if timeout is None
+                                       else timeout * 1000)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            if fd == self._server.fileno():
+                self._accept()
+            elif fd == self.watcher.fileno():
+                if self.watcher.changed():
+                    self.refresh()
+            elif fd in self._clients:
+                if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    self._read(fd)
+                elif event & select.POLLOUT:
+                    self._serve(fd)
+        if self.watcher.fileno() is None and time.time() >= self._next_poll:
+            self._next_poll = time.time() + self.watcher.interval
+            if self.watcher.changed():
+                self.refresh()
+        if time.time() >= self._next_snapshot:
+            # Not after each refresh: the whole table is saved each time
+            self._next_snapshot = time.time() + SNAPSHOT_INTERVAL
+            self.parser.save_snapshot()
+
+    def serve_forever(self):
+        """ Serves until stop() is called """
+        while not self.stopped:
+            self.handle_events(1.0)
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        self.parser.save_snapshot()
+        for fd in list(self._clients):
+            self._close(fd)
+        self._server.close()
+        self.watcher.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def query(socket_path, timeout=5.0, **request):
+    """
+    Sends one request to a LeaseService, e.g. query(path, ip='10.0.0.1'),
+    and returns its answer
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(socket_path)
+        conn.sendall(json.dumps(request) + '\n')
+        data = ''
+        while not data.endswith('\n'):
+            chunk = conn.recv(64 * 1024)
+            if not chunk:
+                raise IOError("connection closed by %s" % socket_path)
+            data += chunk
+    finally:
+        conn.close()
+    return json.loads(data)
+
+
+def usage(msg=None):
+    if msg:
+        sys.stderr.write("%s\n" % msg)
+        sys.stderr.write(usage_msg)
+        return 1
+    sys.stdout.write(usage_msg)
+    return 0
+
+
+def main(args=None):
+    """ The main function of this script
+    returns 0 on success or 1 otherwise
+    """
+    socket_path = None
+    engine = 'tokenizer'
+    interval = POLL_INTERVAL
+    poll = False
+    snapshot = None
+
+    try:
+        opts, remainder = getopt.getopt(
+            sys.argv[1:] if args is None else args, "hs:e:i:p",
+            ['help', 'socket=', 'engine=', 'interval=', 'poll', 'snapshot'])
+    except getopt.GetoptError, err:
+        return usage("Error: %s" % err)
+
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            return usage()
+        elif o in ('-s', '--socket'):
+            socket_path = a
+        elif o in ('-e', '--engine'):
+            if a not in ENGINES:
+                return usage("Error: unknown engine '%s'" % a)
+            engine = a
+        elif o in ('-i', '--interval'):
+            try:
+                interval = float(a)
+            except ValueError:
+                return usage("Error: invalid interval '%s'" % a)
+        elif o in ('-p', '--poll'):
+            poll = True
+        elif o == '--snapshot':
+            snapshot = True
+
+    if len(remainder) != 1:
+        return usage("Error: " + myself + " needs one leases file")
+    leases_filename = remainder[0]
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    parser = DhcpLeasesParser(leases_filename, engine=engine, compact=True,
+                              snapshot=snapshot)
+    watcher = make_watcher(leases_filename, interval, poll)
+    try:
+        service = LeaseService(parser, socket_path or leases_filename + '.sock',
+                               watcher)
+    except (IOError, OSError, socket.error) as err:
+        watcher.close()
+        sys.stderr.write("Error: %s\n" % err)
+        return 1
+    # A service is stopped with SIGTERM: close it as on ^C, so that the
+    # snapshot is saved and the socket removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
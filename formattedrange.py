@@ -17,9 +17,14 @@ list of strings in which the range has been expanded.
   NOTE: same command but without double quotes:
   % ./formattedrange.py b\[01-05\]
 
-  %./formattedrange.py -f"%y%m%d" "b[201202026-20120301]c"
+  %./formattedrange.py -f"%y%m%d" "b[20120226-20120301]c"
   b120226c b120227c b120228c b120229c b120301c
 
+  Dates are written YYYYMMDD, YYYYMMDDHH or YYMMDD, and the step between
+  two dates can be one hour, one day (default) or one week:
+  % ./formattedrange.py -f"%d/%Hh" --step hour "[2012022822-2012022901]"
+  28/22h 28/23h 29/00h 29/01h
+
 * The default delimiter is one space but it can be changed:
   % ./formattedrange.py -d $'\n' "b[01-02]"
   b01
@@ -30,6 +35,10 @@ list of strings in which the range has been expanded.
 
   NOTE: $'\n' is the newline character, $'\t' is the tab character
 
+* Overlapping and duplicated values can be merged and sorted:
+  % ./formattedrange.py -s "b[5-7,1-3,2-4]"
+  b1 b2 b3 b4 b5 b6 b7
+
 * Multiple strings can be given as input:
   % ./formattedrange.py "b[1-2,4]" "c[01-02]"
   b1 b2 b4 c01 c02
@@ -37,21 +46,73 @@ list of strings in which the range has been expanded.
 * You can also pass input strings as stdin with a pipe:
   % echo "b[1-2,4]" | ./formattedrange.py -
   b1 b2 b4
+
+* In batch mode stdin is read line by line and each line is expanded on
+  its own, one output line (or record separator) per input line:
+  % printf "b[1-2]\nc[01-02]\n" | ./formattedrange.py -b
+  b1 b2
+  c01 c02
+
+  % printf "b[1-2]\nc[01-02]\n" | ./formattedrange.py -b -r ';'
+  b1 b2;c01 c02;
+
+  The output of a line is written as soon as no more input is ready, so
+  it also works after a slow producer, e.g. tail -f.
+
+* A list of strings can be collapsed back into formatted ranges:
+  % ./formattedrange.py -c b01 b02 b03 b07 c1
+  b[01-03,07] c1
+
+  % ls | ./formattedrange.py -c -
+
+* Big expansions can be split in contiguous slices, or shards, to share
+  the work between machines, and expanded by several processes:
+  % ./formattedrange.py --shard 2/3 "b[1-9]"
+  b4 b5 b6
+
+  % ./formattedrange.py -j 8 "node[0001-9999]rack[01-64]"
 """
 import sys
 import os
+import bisect
+import calendar
+import collections
+import copy
+import datetime
 import re
 import getopt
 import itertools
+import multiprocessing
+import select
+import signal
 
 myself = os.path.basename(sys.argv[0])
 
+# Size in bytes of the chunks written to stdout by main()
+CHUNK_SIZE = 64 * 1024
+# Number of parsed patterns kept in the template cache
+TEMPLATE_CACHE_SIZE = 1024
+# Number of strings expanded by each task of the process pool in main()
+JOB_ITEMS = 64 * 1024
+
 usage_msg = 'Usage: ' + myself + ' [options...] <string formatted range>' + """
 Options:
  -h/--help                This help text
  -d/--delimiter <char>    Use the given characters as line delimiter
  -f/--format <str>        Specify a date range with given standard date format
+ -t/--step <hour|day|week>
+                          Step between the dates of a date range
  -s/--sort                Sort the results and remove overlapping ranges
+ -b/--batch               Read stdin line by line and expand each line
+ -r/--record-separator <str>
+                          Use the given characters after the expansion of
+                          each line in batch mode (default is newline)
+ -c/--collapse            Do the opposite: collapse a list of strings into
+                          formatted ranges, one numeric field at a time
+                          from the last one (exact, not always minimal)
+ --shard <K/N>            Only output the K-th of N contiguous slices of
+                          each expansion (K from 1 to N)
+ -j/--jobs <num>          Expand using num processes (0 means one per CPU)
 
  Using '-' as last option means read from stdin
 """
@@ -69,21 +130,276 @@ def usage(msg=None):
     sys.stdout.write(usage_msg)
     return err
 
+def write_chunked(items, out, delim=' ', chunk_size=None):
+    """
+    Writes the strings yielded by items to the out stream, separated by
+    delim, in chunks of about chunk_size bytes. Only one chunk is kept in
+    memory at a time and each chunk is flushed as soon as it is full.
+    Returns the number of items written
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    buf = []
+    size = 0
+    count = 0
+    for item in items:
+        if count and delim:
+            buf.append(delim)
+            size += len(delim)
+        buf.append(item)
+        size += len(item)
+        count += 1
+        if size >= chunk_size:
+            out.write(''.join(buf))
+            out.flush()
+            buf = []
+            size = 0
+    if buf:
+        out.write(''.join(buf))
+    out.flush()
+    return count
+
+def expand_task(task):
+    """
+    Expands the strings between the start and stop indexes of a formatted
+    range and returns them joined by delim. The task is a tuple
+    (class, pattern, kwargs, start, stop, delim) so that it can be sent to
+    a worker process
+    """
+    cls, s, kwargs, start, stop, delim = task
+    return delim.join(cls(s, **kwargs).iter(start, stop))
+
+def write_parallel(tasks, out, delim=' ', jobs=None):
+    """
+    Runs expand_task() on each task in a pool of jobs processes and writes
+    the results to out in the order of the tasks, separated by delim. At
+    most two results per process are kept in memory at a time
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs)
+
+    def results():
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(expand_task, (task,)))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    try:
+        write_chunked((r for r in results() if r), out, delim)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def expand_lines(lines, factory, delim=' ', rsep='\n'):
+    """
+    Expands each line of lines on its own with factory (a FormattedRange
+    class or a function returning one) and yields the pieces of the output
+    as they are produced: the strings of a line are separated by delim and
+    the expansion of each line is terminated by rsep
+    """
+    for line in lines:
+        first = True
+        for el in factory(line.rstrip('\r\n')):
+            if first:
+                first = False
+            else:
+                yield delim
+            yield el
+        yield rsep
+
+def write_batch(lines, factory, out, delim=' ', rsep='\n', ready=None,
+                chunk_size=None):
+    """
+    Writes the expansion of each line of lines (see expand_lines()) to the
+    out stream in chunks, like write_chunked(). The output is also flushed
+    after a line when ready() returns False, i.e. when the next line is not
+    there yet, so a slow producer gets each expansion without delay. With
+    no ready function it is flushed after each line
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    buf = []
+    size = 0
+    for line in lines:
+        for piece in expand_lines((line,), factory, delim, rsep):
+            buf.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                out.write(''.join(buf))
+                out.flush()
+                buf = []
+                size = 0
+        if ready is None or not ready():
+            out.write(''.join(buf))
+            out.flush()
+            buf = []
+            size = 0
+    if buf:
+        out.write(''.join(buf))
+    out.flush()
+
+def input_ready(stream):
+    """
+    Returns a function telling if stream can be read without waiting, or
+    None if it has no file descriptor to tell
+    """
+    try:
+        fd = stream.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    return lambda: bool(select.select([fd], [], [], 0)[0])
+
 def str_numrange_to_list(x):
     """
     Converts a string like '1,2,5-7,10' into a list [1, 2, 5, 6, 7, 10]
     """
+    return list(IntervalList(str_numrange_to_intervals(x)))
+
+def str_numrange_to_intervals(x):
+    """
+    Converts a string like '1,2,5-7,10' into a list of inclusive intervals
+    [(1, 1), (2, 2), (5, 7), (10, 10)]
+    """
     result = []
     for part in x.split(','):
         if '-' in part:
             a, b = part.split('-')
-            a, b = int(a), int(b)
-            result.extend(range(a, b + 1))
+            result.append((int(a), int(b)))
         else:
             a = int(part)
-            result.append(a)
+            result.append((a, a))
+    return result
+
+def merge_intervals(intervals):
+    """
+    Sorts a list of inclusive intervals and merges the overlapping and
+    adjacent ones, e.g. [(1, 50), (20, 80), (81, 90)] -> [(1, 90)].
+    Empty intervals (first > last) are dropped. Cost is O(k log k) in the
+    number of intervals, whatever their size
+    """
+    result = []
+    for a, b in sorted(i for i in intervals if i[0] <= i[1]):
+        if result and a <= result[-1][1] + 1:
+            if b > result[-1][1]:
+                result[-1] = (result[-1][0], b)
+        else:
+            result.append((a, b))
     return result
 
+def intersect_intervals(a, b):
+    """
+    Returns the intersection of two sorted lists of disjoint intervals (as
+    returned by merge_intervals), e.g. [(1, 10)], [(5, 20)] -> [(5, 10)]
+    """
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        first = max(a[i][0], b[j][0])
+        last = min(a[i][1], b[j][1])
+        if first <= last:
+            result.append((first, last))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+def subtract_intervals(a, b):
+    """
+    Returns the values of a which are not in b, both being sorted lists of
+    disjoint intervals, e.g. [(1, 10)], [(3, 4)] -> [(1, 2), (5, 10)]
+    """
+    result = []
+    j = 0
+    for first, last in a:
+        while j < len(b) and b[j][1] < first:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] <= last:
+            if b[k][0] > first:
+                result.append((first, b[k][0] - 1))
+            first = max(first, b[k][1] + 1)
+            k += 1
+        if first <= last:
+            result.append((first, last))
+    return result
+
+def intervals_to_str(intervals, width=0):
+    """
+    Converts a list of intervals like [(1, 3), (7, 7)] into the string
+    '1-3,7', the numbers being zero-filled to width digits
+    """
+    parts = []
+    for a, b in intervals:
+        if a == b:
+            parts.append(str(a).zfill(width))
+        else:
+            parts.append(str(a).zfill(width) + '-' + str(b).zfill(width))
+    return ','.join(parts)
+
+
+class IntervalList(object):
+    """
+    A read-only sequence of integers stored as a list of inclusive
+    (first, last) intervals, so that its size depends on the number of
+    intervals and not on the number of values
+    """
+    def __init__(self, intervals):
+        self.intervals = tuple((a, b) for a, b in intervals if a <= b)
+        # Index in the sequence of the first value of each interval
+        self._offsets = []
+        total = 0
+        for a, b in self.intervals:
+            self._offsets.append(total)
+            total += b - a + 1
+        self._len = total
+        # Sorted disjoint intervals can be searched with bisect
+        self._firsts = [a for a, b in self.intervals]
+        self._sorted = all(self.intervals[n - 1][1] < self.intervals[n][0]
+                           for n in range(1, len(self.intervals)))
+
+    def __len__(self):
+        return self._len
+
+    def index(self, value):
+        """
+        Returns the index of the first occurrence of value, in O(log k) when
+        the intervals are sorted (O(k) otherwise). Raises ValueError if
+        value is not in the sequence
+        """
+        if self._sorted:
+            n = bisect.bisect_right(self._firsts, value) - 1
+            if n >= 0 and value <= self.intervals[n][1]:
+                return self._offsets[n] + value - self.intervals[n][0]
+        else:
+            for n, (a, b) in enumerate(self.intervals):
+                if a <= value <= b:
+                    return self._offsets[n] + value - a
+        raise ValueError("%r is not in IntervalList" % (value,))
+
+    def __contains__(self, value):
+        try:
+            self.index(value)
+        except ValueError:
+            return False
+        return True
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("IntervalList index out of range")
+        n = bisect.bisect_right(self._offsets, index) - 1
+        return self.intervals[n][0] + index - self._offsets[n]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(xrange(a, b + 1)
+                                             for a, b in self.intervals)
+
+    def __repr__(self):
+        return "IntervalList(%r)" % (list(self.intervals),)
+
 """
 # Another way to do the same thing with list comprehensions:
 def str_numrange_to_list(x):
@@ -96,6 +412,63 @@ class FormattedRangeError(Exception):
     pass
 
 
+class RangeTemplate(collections.namedtuple('RangeTemplate',
+                                           'values zfills')):
+    """
+    The immutable result of parsing the brackets of a formatted range
+    string: the values of each bracket and its zero-fill width. Templates
+    are shared between all the objects whose patterns have the same
+    brackets, whatever the text around them, so the values must never be
+    modified
+    """
+    __slots__ = ()
+
+
+class LRUCache(object):
+    """
+    A mapping holding at most maxsize entries, the least recently used ones
+    being dropped first. Counts the lookups which hit and missed the cache
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Move the entry to the most recently used end
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        """ Returns a dict with the hit/miss counters and the cache size """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+# Parsed patterns, shared by all FormattedRange objects
+template_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+
 class FormattedRange(object):
     """
     A class which knows how to parse a formatted range string and
@@ -104,6 +477,7 @@ class FormattedRange(object):
 
     my_regexp = re.compile("([^\[\]]*)(\[[^\[\]]*\])([^\[\]]*)")
     my_regexp2 = re.compile('(\d+)\-(\d+)')
+    digits_regexp = re.compile('(\d+)')
 
     def __init__(self, s, sep=None, sort=False):
         self._s = s
@@ -115,94 +489,616 @@ class FormattedRange(object):
         self._hascomma = False
         self._formatted = False
 
-        self._int_ls = []
+        self._int_ls = ()
+        # Zero-fill width of each component (0 means no formatting)
+        self._zfill_ls = ()
         self._setup()
 
     def _setup(self):
         # a[01-02]b[01-10]c -> [('a', '[01-02]', 'b'), ('', '[01-10]', 'c')]
-        found = self.my_regexp.findall(self._s) or []
-        for n in found:
-            self._begin, self._extended, self._end = n[0], self._get_range(n[1]), n[2]
-            self._int_ls.append((self._begin, self._extended, self._end))
+        found = self.my_regexp.findall(self._s)
+        # The brackets are only parsed once for all the patterns which have
+        # the same ones, e.g. h1-[01-08], h2-[01-08]...
+        brackets = tuple(bracket for b, bracket, e in found)
+        key = self._cache_key(brackets)
+        template = template_cache.get(key)
+        if template is None:
+            template = self._compile(brackets)
+            template_cache.put(key, template)
+        self._int_ls = tuple((b, values, e) for (b, bracket, e), values
+                             in zip(found, template.values))
+        self._zfill_ls = template.zfills
+        if self._int_ls:
+            self._begin, self._extended, self._end = self._int_ls[-1]
+
+    def _cache_key(self, brackets):
+        """ Returns the key of the parsed brackets in the template cache """
+        return (self.__class__, brackets, self._sort)
+
+    def _compile(self, brackets):
+        """ Parses the brackets of the pattern into a RangeTemplate """
+        values = []
+        zfill_ls = []
+        for bracket in brackets:
+            self._formatted = False
+            values.append(self._get_range(bracket))
+            zfill_ls.append(self._zfill if self._formatted else 0)
+        return RangeTemplate(tuple(values), tuple(zfill_ls))
+
+    def _get_msg(self, n):
+        """ Returns the format string used for the n-th component """
+        if self._zfill_ls[n]:
+            # Use X digits formatting
+            return "%s%0" + str(self._zfill_ls[n]) + "d%s"
+        return self._msg
 
     def _get_range(self, range_str):
         range_str = range_str.replace('[', '').replace(']', '')
-        if range_str.startswith('0'):
+        # Zero-filled when the first number has a leading zero: a lone 0,
+        # as in [0,10-11], is not
+        if re.match(r'0\d', range_str):
             self._formatted = True
-        found = self.my_regexp2.search(range_str)
+        # The width of the first a-b range, or of the first number when
+        # the bracket only holds single values like [01,07]
+        found = (self.my_regexp2.search(range_str) or
+                 self.digits_regexp.match(range_str))
         if found:
             self._zfill = len(found.group(1))
-            if ',' not in range_str:
-                return range(int(found.group(1)), int(found.group(2)) + 1)
-            else:
-                return str_numrange_to_list(range_str)
+            # Keep the intervals as they are: memory depends on the number
+            # of sub-ranges and not on the number of values
+            try:
+                intervals = str_numrange_to_intervals(range_str)
+            except ValueError:
+                raise FormattedRangeError("Could not parse range string")
+            if self._sort:
+                intervals = merge_intervals(intervals)
+            return IntervalList(intervals)
         else:
             raise FormattedRangeError("Could not parse range string")
 
-    def get(self):
+    def count(self):
+        """
+        Returns the number of strings in the expansion, computed from the
+        size of each component without expanding anything
+        """
+        total = 1
+        for b, r, e in self._int_ls:
+            total *= len(r)
+        return total
+
+    def __len__(self):
+        return self.count()
+
+    def _digits(self, index):
+        """
+        Converts an index of the expansion into the list of indexes in each
+        component (mixed-radix, the last component being the least
+        significant digit)
+        """
+        digits = [0] * len(self._int_ls)
+        for n in reversed(range(len(self._int_ls))):
+            index, digits[n] = divmod(index, len(self._int_ls[n][1]))
+        return digits
+
+    def _item(self, index):
         if not self._int_ls:
-            return [self._s]
+            return self._s
+        parts = []
+        for n, i in enumerate(self._digits(index)):
+            b, r, e = self._int_ls[n]
+            parts.append(self._get_msg(n) % (b, r[i], e))
+        return ''.join(parts)
 
-        if self._formatted:
-            # Use X digits formatting
-            self._msg = "%s%0" + str(self._zfill) + "d%s"
+    def __getitem__(self, key):
+        total = self.count()
+        if isinstance(key, slice):
+            start, stop, step = key.indices(total)
+            if step == 1:
+                return list(self.iter(start, stop))
+            return [self._item(i) for i in range(start, stop, step)]
+        if key < 0:
+            key += total
+        if not 0 <= key < total:
+            raise IndexError("FormattedRange index out of range")
+        return self._item(key)
+
+    def _match_value(self, n, s, pos):
+        """
+        Yields (index in the n-th component, end position) for each value
+        of the n-th component which is written in s at position pos,
+        longest first
+        """
+        found = self.digits_regexp.match(s, pos)
+        if not found:
+            return
+        run = found.group(0)
+        values = self._int_ls[n][1]
+        width = self._zfill_ls[n]
+        for length in range(len(run), 0, -1):
+            token = run[:length]
+            value = int(token)
+            # The digits must be written exactly as get() would write them
+            if token != str(value).zfill(width):
+                continue
+            try:
+                yield values.index(value), pos + length
+            except ValueError:
+                pass
+
+    def _lookup(self, s, pos=0, n=0):
+        """
+        Returns the list of the indexes in each component (from the n-th
+        one) which give string s from position pos, or None
+        """
+        if n == len(self._int_ls):
+            return [] if pos == len(s) else None
+        b, r, e = self._int_ls[n]
+        if not s.startswith(b, pos):
+            return None
+        for i, end in self._match_value(n, s, pos + len(b)):
+            if s.startswith(e, end):
+                rest = self._lookup(s, end + len(e), n + 1)
+                if rest is not None:
+                    return [i] + rest
+        return None
+
+    def contains(self, s):
+        """
+        Returns True if s is one of the strings of the expansion. The string
+        is matched against the prefix/suffix of each component and its
+        values are searched in the intervals, nothing is expanded
+        """
+        if not self._int_ls:
+            return s == self._s
+        return self._lookup(s) is not None
+
+    def __contains__(self, s):
+        return self.contains(s)
+
+    def index(self, s):
+        """
+        Returns the index of s in the expansion, such that self[index] == s,
+        without expanding anything. Raises ValueError if s is not found
+        """
+        digits = self._lookup(s) if self._int_ls else ([] if s == self._s
+                                                       else None)
+        if digits is None:
+            raise ValueError("%r is not in %s" % (s, self._s))
+        index = 0
+        for n, i in enumerate(digits):
+            index = index * len(self._int_ls[n][1]) + i
+        return index
+
+    def shard_bounds(self, k, n):
+        """
+        Returns the (start, stop) indexes of the k-th of n contiguous slices
+        of the expansion, k going from 1 to n. The slices have the same size
+        give or take one string
+        """
+        if not 1 <= k <= n:
+            raise ValueError("Shard %d/%d: need 1 <= k <= n" % (k, n))
+        total = self.count()
+        return total * (k - 1) // n, total * k // n
+
+    def shard(self, k, n):
+        """
+        Returns a generator over the k-th of n contiguous slices of the
+        expansion (see shard_bounds), e.g. for k in 1..n on n machines
+        """
+        return self.iter(*self.shard_bounds(k, n))
+
+    def _merged(self, n):
+        values = self._int_ls[n][1]
+        if not isinstance(values, IntervalList):
+            raise FormattedRangeError("Set operations need numerical ranges")
+        return merge_intervals(values.intervals)
+
+    def _check_shape(self, other):
+        """
+        Set operations are only possible between formatted ranges which
+        have the same literals around the same number of brackets, whose
+        values are written the same way. Returns the zero-fill widths to
+        use for the result
+        """
+        if (self.__class__ is not other.__class__ or not self._int_ls or
+                [(b, e) for b, r, e in self._int_ls] !=
+                [(b, e) for b, r, e in other._int_ls]):
+            raise FormattedRangeError("%s and %s do not have the same shape" %
+                                      (self._s, other._s))
+        zfill_ls = []
+        for n in range(len(self._int_ls)):
+            widths = [(self._zfill_ls[n], self), (other._zfill_ls[n], other)]
+            widths.sort()
+            # The narrower zero-fill is fine if all its values already
+            # have as many digits as the wider one
+            narrow = widths[0][1]._merged(n)
+            if (widths[0][0] != widths[1][0] and narrow and
+                    narrow[0][0] < 10 ** (widths[1][0] - 1)):
+                raise FormattedRangeError("%s and %s do not have the same "
+                                          "zero-fill" % (self._s, other._s))
+            zfill_ls.append(widths[1][0])
+        return zfill_ls
 
-        expanded = [None] * len(self._int_ls)
-        i = 0
-        for n, (b, r, e) in enumerate(self._int_ls):
-            expanded[n] = []
-            for el in r:
-                msg = self._msg % (b, el, e)
-                expanded[n].append(msg)
+    def _derive(self, components, zfill_ls):
+        """
+        Returns a copy of this object with the given sorted lists of
+        intervals as values of its components
+        """
+        new = copy.copy(self)
+        new._sort = True
+        new._zfill_ls = tuple(zfill_ls)
+        new._int_ls = tuple((b, IntervalList(c), e) for (b, r, e), c
+                            in zip(self._int_ls, components))
+        new._begin, new._extended, new._end = new._int_ls[-1]
+        new._s = ''.join("%s[%s]%s" % (b, intervals_to_str(r.intervals, w), e)
+                         for (b, r, e), w in zip(new._int_ls, zfill_ls))
+        return new
 
-        ret = []
-        for element in itertools.product(*expanded):
-            ret.append(''.join(element))
+    def intersection(self, other):
+        """
+        Returns a new formatted range with the strings of both self and
+        other. Like the other set operations the values are computed on the
+        intervals of each component and come out sorted
+        """
+        zfill_ls = self._check_shape(other)
+        return self._derive([intersect_intervals(self._merged(n),
+                                                 other._merged(n))
+                             for n in range(len(self._int_ls))], zfill_ls)
 
-        return ret
+    def union(self, other):
+        """
+        Returns a new formatted range with the strings of self or other.
+        Raises FormattedRangeError if the union can't be written as one
+        formatted range, i.e. if the ranges differ in more than one bracket
+        """
+        zfill_ls = self._check_shape(other)
+        mine = [self._merged(n) for n in range(len(self._int_ls))]
+        theirs = [other._merged(n) for n in range(len(self._int_ls))]
+        differ = [n for n in range(len(mine)) if mine[n] != theirs[n]]
+        if not differ:
+            return self._derive(mine, zfill_ls)
+        if all(subtract_intervals(m, t) == [] for m, t in zip(mine, theirs)):
+            return self._derive(theirs, zfill_ls)
+        if all(subtract_intervals(t, m) == [] for m, t in zip(mine, theirs)):
+            return self._derive(mine, zfill_ls)
+        if len(differ) > 1:
+            raise FormattedRangeError("The union of %s and %s is not a "
+                                      "formatted range" % (self._s, other._s))
+        n = differ[0]
+        mine[n] = merge_intervals(mine[n] + theirs[n])
+        return self._derive(mine, zfill_ls)
+
+    def difference(self, other):
+        """
+        Returns a new formatted range with the strings of self which are not
+        in other. Raises FormattedRangeError if the difference can't be
+        written as one formatted range
+        """
+        zfill_ls = self._check_shape(other)
+        mine = [self._merged(n) for n in range(len(self._int_ls))]
+        theirs = [other._merged(n) for n in range(len(self._int_ls))]
+        if any(intersect_intervals(m, t) == [] for m, t in zip(mine, theirs)):
+            # Nothing in common
+            return self._derive(mine, zfill_ls)
+        # The brackets of self which are not fully covered by other
+        differ = [n for n in range(len(mine))
+                  if subtract_intervals(mine[n], theirs[n])]
+        if not differ:
+            return self._derive([[] for m in mine], zfill_ls)
+        if len(differ) > 1:
+            raise FormattedRangeError("The difference of %s and %s is not a "
+                                      "formatted range" % (self._s, other._s))
+        n = differ[0]
+        mine[n] = subtract_intervals(mine[n], theirs[n])
+        return self._derive(mine, zfill_ls)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def iter(self, start=0, stop=None):
+        """
+        Returns a generator yielding the expanded strings one at a time, in
+        the same order as get(), without building the whole list in memory.
+        Only the strings with an index between start and stop are generated
+        """
+        total = self.count()
+        if stop is None or stop > total:
+            stop = total
+        if start >= stop:
+            return iter([])
+        if not self._int_ls:
+            return iter([self._s])
+        it = self._expand(0, '', self._digits(start) if start else None)
+        if stop < total:
+            it = itertools.islice(it, stop - start)
+        return it
+
+    def _expand(self, n, head, first=None):
+        # Walk the components like an odometer: only one value per bracket
+        # is alive at any time, the last bracket changing fastest. The
+        # first row starts at the component indexes given by first
+        b, r, e = self._int_ls[n]
+        msg = self._get_msg(n)
+        if first and first[n]:
+            values = (r[i] for i in xrange(first[n], len(r)))
+        else:
+            values = r
+        if n == len(self._int_ls) - 1:
+            for el in values:
+                yield head + msg % (b, el, e)
+        else:
+            for el in values:
+                for tail in self._expand(n + 1, head + msg % (b, el, e), first):
+                    yield tail
+                first = None
+
+    def __iter__(self):
+        return self.iter()
+
+    def get(self):
+        return list(self.iter())
 
     def __str__(self):
-        return self._sep.join(self.get())
+        return self._sep.join(self.iter())
 
 
 class FormattedDateRangeError(Exception):
     pass
 
+# Steps of a date range, in hours
+DATE_STEPS = {'hour': 1, 'day': 24, 'week': 24 * 7}
+# Number of (format, year, month) tables of formatted dates kept in memory
+MONTH_CACHE_SIZE = 1024
+
+# (format, year, month) -> list of the formatted date of each hour of the
+# month, filled lazily, shared by all the date ranges
+month_cache = LRUCache(MONTH_CACHE_SIZE)
+
+def parse_date(digits):
+    """
+    Converts a date written YYYYMMDD, YYYYMMDDHH or YYMMDD into the number
+    of hours since the beginning of the proleptic Gregorian calendar
+    """
+    try:
+        if len(digits) == 6:
+            year = int(digits[0:2])
+            year += 2000 if year < 69 else 1900
+            d = datetime.date(year, int(digits[2:4]), int(digits[4:6]))
+            hour = 0
+        elif len(digits) in (8, 10):
+            d = datetime.date(int(digits[0:4]), int(digits[4:6]),
+                              int(digits[6:8]))
+            hour = int(digits[8:10] or 0)
+            if hour > 23:
+                raise ValueError("hour must be in 0..23")
+        else:
+            raise ValueError("Unknown date format: %s" % digits)
+    except ValueError, e:
+        raise FormattedDateRangeError(e)
+    return d.toordinal() * 24 + hour
+
+
+class DateList(object):
+    """
+    A read-only sequence of the dates from first to last (both included,
+    in hours as returned by parse_date) every step hours, formatted with
+    date_format. Dates are computed with ordinal arithmetic and their
+    strings are looked up in per-month tables, so strftime is called once
+    per distinct date and format
+    """
+    def __init__(self, first, last, step, date_format):
+        self.first = first
+        self.last = last
+        self.step = step
+        self.date_format = date_format
+        if last >= first:
+            self._len = (last - first) // step + 1
+        else:
+            self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _month(self, t):
+        """
+        Returns the first hour of the month holding hour t, the first hour
+        of the next month and the table of the formatted dates of the month
+        """
+        d = datetime.date.fromordinal(t // 24)
+        start = (d.toordinal() - d.day + 1) * 24
+        days = calendar.monthrange(d.year, d.month)[1]
+        key = (self.date_format, d.year, d.month)
+        table = month_cache.get(key)
+        if table is None:
+            table = [None] * (days * 24)
+            month_cache.put(key, table)
+        return start, start + days * 24, table
+
+    def _format(self, t, start, table):
+        i = t - start
+        s = table[i]
+        if s is None:
+            day, hour = divmod(t, 24)
+            d = datetime.date.fromordinal(day)
+            s = table[i] = datetime.datetime(d.year, d.month, d.day,
+                                             hour).strftime(self.date_format)
+        return s
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("DateList index out of range")
+        t = self.first + index * self.step
+        start, end, table = self._month(t)
+        return self._format(t, start, table)
+
+    def __iter__(self):
+        t, step, last = self.first, self.step, self.last
+        while t <= last:
+            start, end, table = self._month(t)
+            stop = min(last, end - 1)
+            while t <= stop:
+                s = table[t - start]
+                if s is None:
+                    s = self._format(t, start, table)
+                yield s
+                t += step
+
+    def index(self, s):
+        """
+        Returns the index of the date written s. The string is parsed back
+        with the date format when possible, otherwise the dates are scanned.
+        Raises ValueError if s is not in the sequence
+        """
+        try:
+            d = datetime.datetime.strptime(s, self.date_format)
+            t = d.toordinal() * 24 + d.hour
+            if (t - self.first) % self.step == 0:
+                i = (t - self.first) // self.step
+                if 0 <= i < self._len and self[i] == s:
+                    return i
+        except ValueError:
+            pass
+        # The format may lack some fields, like the year in %m%d
+        for i, date in enumerate(self):
+            if date == s:
+                return i
+        raise ValueError("%r is not in DateList" % (s,))
+
 
 class FormattedDateRange(FormattedRange):
     """
     A class which knows how to parse a datetime range and return it as a list
     of strings
     """
-    def __init__(self, s, date_format="%Y%m%d", sep=None, sort=False):
+    def __init__(self, s, date_format="%Y%m%d", sep=None, sort=False,
+                 step='day'):
         self._date_format = date_format
+        if step not in DATE_STEPS:
+            raise FormattedDateRangeError("Unknown step: %s" % step)
+        self._step = step
         FormattedRange.__init__(self, s, sep=sep, sort=sort)
         self._msg = "%s%s%s"
 
+    def _cache_key(self, brackets):
+        return (self.__class__, brackets, self._sort, self._date_format,
+                self._step)
+
+    def _match_value(self, n, s, pos):
+        values = self._int_ls[n][1]
+        for end in range(len(s), pos, -1):
+            try:
+                yield values.index(s[pos:end]), end
+            except ValueError:
+                pass
+
     def _get_range(self, range_str):
         range_str = range_str.replace('[', '').replace(']', '')
-        from dateutil import parser, rrule
         self._formatted = False
         found = self.my_regexp2.search(range_str)
         if found:
-            try:
-                d1 = parser.parse(found.group(1))
-                d2 = parser.parse(found.group(2))
-                r = rrule.rrule(rrule.DAILY, dtstart=d1, until=d2)
-            except ValueError, e:
-                raise FormattedDateRangeError(e)
-            return [i.strftime(self._date_format) for i in r]
+            return DateList(parse_date(found.group(1)),
+                            parse_date(found.group(2)),
+                            DATE_STEPS[self._step], self._date_format)
         else:
             raise FormattedDateRangeError("Could not parse range string")
 
-    def get(self):
-        if not self._int_ls:
-            return [self._s]
-        ls = self._extended
-        ret = []
-        for i in ls:
-            ret.append(self._msg % (self._begin, i, self._end))
-        return ret
+
+# A numeric field of a name: a number, or a bracket made by an earlier pass
+COLLAPSE_FIELD = r'(?:(?<!\d)\d+|\[[^\]]*\])'
+# Text between two fields
+COLLAPSE_GAP = r'[^\d\[\]]*'
+collapse_more_regexp = re.compile(r'[\d\[]')
+
+
+def collapse(names):
+    """
+    The inverse of FormattedRange: converts an iterable of strings like
+    ['b01', 'b02', 'b03', 'b07', 'c1'] into the list of formatted ranges
+    ['b[01-03,07]', 'c1'].
+
+    The numeric fields are collapsed one at a time, from the last one: the
+    names are grouped by the text around the field and by zero-fill width,
+    so that e.g. node0001rack01 ... node0009rack64 become
+    node[0001-0009]rack[01-64] in two passes. The result is exact, but it is
+    not always the shortest possible one: a field is only merged when the
+    rest of the names is the same. The numbers of each group are sorted
+    once, so each pass costs O(n log n) and holds one int per name
+    """
+    names = set(names)
+    field = 1
+    while True:
+        names, more = _collapse_field(names, field)
+        if not more:
+            return names
+        field += 1
+
+
+def _collapse_field(names, field):
+    """
+    Collapses the field-th numeric field (from the end) of the names, see
+    collapse(). Returns the new list of names, and whether some of them have
+    a field before this one
+    """
+    # name -> (text before the field, the field, text after it)
+    field_regexp = re.compile('^(.*)(%s)((?:%s%s){%d}%s)$' % (
+        COLLAPSE_FIELD, COLLAPSE_GAP, COLLAPSE_FIELD, field - 1,
+        COLLAPSE_GAP), re.DOTALL)
+    # (prefix, suffix) -> {width or -length: [numbers]}, where the zero-
+    # filled numbers are keyed by their width and the others by -length
+    groups = collections.defaultdict(lambda: collections.defaultdict(list))
+    literals = set()
+    more = False
+    for name in names:
+        found = field_regexp.match(name)
+        if not found:
+            literals.add(name)
+            continue
+        prefix, digits, suffix = found.groups()
+        if digits.startswith('['):
+            literals.add(name)
+            more = more or bool(collapse_more_regexp.search(prefix))
+            continue
+        if len(digits) > 1 and digits.startswith('0'):
+            key = len(digits)
+        else:
+            key = -len(digits)
+        groups[(prefix, suffix)][key].append(int(digits))
+
+    result = sorted(literals)
+    for (prefix, suffix) in sorted(groups):
+        more = more or bool(collapse_more_regexp.search(prefix))
+        by_width = groups[(prefix, suffix)]
+        # Numbers which are as long as a zero-filled width of the group
+        # (like 10 with 01-09) are written the same way with it
+        for key in [k for k in by_width if k < 0]:
+            if -key in by_width:
+                by_width[-key].extend(by_width.pop(key))
+        unpadded = []
+        for key in [k for k in by_width if k < 0]:
+            unpadded.extend(by_width.pop(key))
+        if unpadded:
+            by_width[0] = unpadded
+        for width in sorted(by_width):
+            intervals = []
+            for v in sorted(by_width[width]):
+                if intervals and v <= intervals[-1][1] + 1:
+                    intervals[-1][1] = v
+                else:
+                    intervals.append([v, v])
+            ranges = intervals_to_str(intervals, width)
+            if len(intervals) == 1 and intervals[0][0] == intervals[0][1]:
+                result.append(prefix + ranges + suffix)
+            else:
+                result.append("%s[%s]%s" % (prefix, ranges, suffix))
+    return result, more
 
 
 def main(args=None):
@@ -210,8 +1106,14 @@ def main(args=None):
     returns 0 on success or 1 otherwise
     """
     delim = ' '
+    rsep = '\n'
     format_opt = None
+    step = 'day'
     sort = False
+    batch = False
+    collapse_opt = False
+    shard = None
+    jobs = None
 
     cliargs = args or sys.argv[1:]
 
@@ -221,8 +1123,10 @@ def main(args=None):
     opts = None
     remainder = None
     try:
-        opts, remainder = getopt.getopt(cliargs, "hsd:f:",
-                                ['help', 'sort', 'delimiter=', 'format='])
+        opts, remainder = getopt.getopt(cliargs, "hsbcd:f:t:r:j:",
+                                ['help', 'sort', 'batch', 'collapse',
+                                 'delimiter=', 'format=', 'step=',
+                                 'record-separator=', 'shard=', 'jobs='])
     except getopt.GetoptError, err:
         return usage("Error: %s" % err)
 
@@ -233,8 +1137,67 @@ def main(args=None):
             delim = a
         elif o in ('-f', '--format'):
             format_opt = a
+        elif o in ('-t', '--step'):
+            if a not in DATE_STEPS:
+                return usage("Error: unknown step '%s'" % a)
+            step = a
         elif o in ('-s', '--sort'):
             sort = True
+        elif o in ('-b', '--batch'):
+            batch = True
+        elif o in ('-r', '--record-separator'):
+            rsep = a
+        elif o in ('-c', '--collapse'):
+            collapse_opt = True
+        elif o == '--shard':
+            try:
+                shard = [int(x) for x in a.split('/')]
+                k, n = shard
+            except ValueError:
+                return usage("Error: --shard needs K/N, got '%s'" % a)
+            if not 1 <= k <= n:
+                return usage("Error: --shard K/N needs 1 <= K <= N")
+        elif o in ('-j', '--jobs'):
+            try:
+                jobs = int(a)
+            except ValueError:
+                return usage("Error: --jobs needs a number, got '%s'" % a)
+            if jobs < 1:
+                jobs = multiprocessing.cpu_count()
+
+    if format_opt is None:
+        cls, kwargs = FormattedRange, {'sep': delim, 'sort': sort}
+    else:
+        cls, kwargs = FormattedDateRange, {'date_format': format_opt,
+                                           'sep': delim, 'sort': sort,
+                                           'step': step}
+
+    def make_range(s):
+        return cls(s, **kwargs)
+
+    if batch:
+        if [arg for arg in remainder if arg != '-']:
+            return usage("Error: -b reads the strings from stdin, not from "
+                         "the arguments")
+        # Read one line at a time and stream the output of each one, so
+        # memory does not depend on the amount of input
+        lines = iter(sys.stdin.readline, '')
+        write_batch(lines, make_range, sys.stdout, delim, rsep,
+                    input_ready(sys.stdin))
+        return 0
+
+    if collapse_opt:
+        if '-' in remainder:
+            # Names are read as whitespace separated words, line by line
+            names = (name for line in iter(sys.stdin.readline, '')
+                     for name in line.split())
+        elif remainder:
+            names = remainder
+        else:
+            return usage("Error: " + myself + " -c needs strings to collapse")
+        write_chunked(collapse(names), sys.stdout, delim)
+        sys.stdout.write('\n')
+        return 0
 
     # To use stdin to input cmd use '-' (to use in cmd pipes)
     if '-' in cliargs:
@@ -244,18 +1207,34 @@ def main(args=None):
     if not remainder:
         return usage("Error: " + myself + errmsg)
 
-    for n, i in enumerate(remainder):
-        if format_opt is None:
-            sys.stdout.write(str(FormattedRange(i, sep=delim, sort=sort)))
-        else:
-            sys.stdout.write(str(FormattedDateRange(i, date_format=format_opt,
-                                                    sep=delim, sort=sort)))
-        if n < len(remainder) - 1:
-            sys.stdout.write(delim)
-        else:
-            sys.stdout.write('\n')
+    def bounds(fr):
+        if shard:
+            return fr.shard_bounds(*shard)
+        return 0, fr.count()
+
+    def ranges():
+        for i in remainder:
+            fr = make_range(i)
+            for el in fr.iter(*bounds(fr)):
+                yield el
+
+    def tasks():
+        for i in remainder:
+            start, stop = bounds(make_range(i))
+            while start < stop:
+                yield (cls, i, kwargs, start, min(start + JOB_ITEMS, stop),
+                       delim)
+                start += JOB_ITEMS
+
+    if jobs:
+        write_parallel(tasks(), sys.stdout, delim, jobs)
+    else:
+        write_chunked(ranges(), sys.stdout, delim)
+    sys.stdout.write('\n')
 
     return 0
 
 if __name__ == "__main__":
+    # Die quietly when the reader goes away, e.g. when piped into head
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     sys.exit(main())
@@ -0,0 +1,576 @@
+import csv
+import contextlib
+import json
+import os
+import sys
+import random
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from nose.tools import eq_, ok_
+from mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dhcp'))
+import dhcp
+from dhcp import DhcpLeasesParser, LeasesTokenizer
+
+LEASES = r"""# The format of this file is documented in the dhcpd.leases(5) manual page.
+# This lease file was written by isc-dhcp-4.2.4
+
+lease 192.168.1.10 {
+  starts 4 2015/08/13 10:58:00;
+  ends 4 2015/08/13 22:58:00;
+  cltt 4 2015/08/13 10:58:00;
+  binding state active;
+  next binding state free;
+  hardware ethernet 00:11:22:33:44:55;
+  uid "\001\000\021\"3DU";
+  client-hostname "host-a";
+}
+lease 192.168.1.11 {
+  starts 4 2015/08/13 10:58:00;
+  ends never;
+  binding state active;
+  hardware ethernet 00:11:22:33:44:56;
+}
+lease 192.168.1.12 {
+  starts 4 2015/08/13 10:58:00;
+  binding state active;
+  set vendor-class-identifier = "MSFT 5.0";
+}
+lease 192.168.1.13 {
+  binding state free;
+}
+lease 192.168.1.10 {
+  starts 5 2015/08/14 10:58:00; # comment
+  ends 5 2015/08/14 22:58:00;
+  tstp 5 2015/08/14 22:58:00;
+  binding state active;
+  hardware ethernet 00:11:22:33:44:99;
+  client-hostname "host-b";
+}
+"""
+
+def random_leases(rnd, count):
+    """ Returns the text of a leases file with count random lease blocks """
+    out = ["# random leases\n", "server-duid \"\\000\\001\";\n"]
+    for n in range(count):
+        ip = "10.0.%d.%d" % (rnd.randint(0, 3), rnd.randint(0, 40))
+        stmts = []
+        day = "%d 2015/%02d/%02d %02d:%02d:00" % (
+            rnd.randint(0, 6), rnd.randint(1, 12), rnd.randint(1, 28),
+            rnd.randint(0, 23), rnd.randint(0, 59))
+        for kw in ('starts', 'ends', 'tstp', 'tsfp', 'atsfp', 'cltt'):
+            if rnd.random() < 0.6:
+                stmts.append("%s %s;" % (kw, day))
+        if rnd.random() < 0.1:
+            stmts.append("ends never;")
+        state = rnd.choice(['active'] * 4 + ['free', 'backup', 'expired',
+                                             'abandoned'])
+        stmts.append("binding state %s;" % state)
+        if rnd.random() < 0.5:
+            stmts.append("next binding state free;")
+        if rnd.random() < 0.9:
+            mac = ":".join("%02x" % rnd.randint(0, 255) for i in range(6))
+            stmts.append("hardware ethernet %s;" % mac)
+        if rnd.random() < 0.5:
+            stmts.append('uid "\\001\\000\\"%d";' % n)
+        if rnd.random() < 0.5:
+            stmts.append('client-hostname "host-%d\\tx#y";' % n)
+        if rnd.random() < 0.05:
+            # Not in the grammar: the whole lease is ignored
+            stmts.append('set ddns-fwd-name = "x%d";' % n)
+        if rnd.random() < 0.03:
+            stmts.append("hardware ethernet 00:11:22;")
+        rnd.shuffle(stmts)
+        if rnd.random() < 0.1:
+            out.append("lease %s {%s}\n" % (ip, " ".join(stmts)))
+        else:
+            out.append("lease %s {\n  %s\n}\n" % (ip, "\n  ".join(stmts)))
+        if rnd.random() < 0.1:
+            out.append("# lease %s was here\n" % ip)
+    return ''.join(out)
+
+
+@contextlib.contextmanager
+def local_tz(tz):
+    """ Runs the block in the tz time zone, e.g. 'UTC' """
+    saved_tz = os.environ.get('TZ')
+    os.environ['TZ'] = tz
+    time.tzset()
+    dhcp.timestamp_cache.clear()
+    try:
+        yield
+    finally:
+        dhcp.timestamp_cache.clear()
+        if saved_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = saved_tz
+        time.tzset()
+
+
+class TestDhcpLeasesParser(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.leases')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def write(self, text):
+        with open(self.filename, 'wb') as f:
+            f.write(text)
+
+    def parse(self, engine):
+        lease_parser = DhcpLeasesParser(self.filename, engine=engine)
+        lease_parser.parse()
+        return lease_parser
+
+    def test_parse(self):
+        self.write(LEASES)
+        for engine in dhcp.ENGINES:
+            res = self.parse(engine)
+            hosts = res.get_hosts()
+            eq_([h['ip_addr'] for h in hosts],
+                ['192.168.1.10', '192.168.1.11'])
+            eq_(hosts[0]['mac_addr'], '00:11:22:33:44:99')
+            eq_(hosts[0]['client_hostname'], 'host-b')
+            eq_(hosts[0]['cltt'], ('', ''))
+            eq_(hosts[1]['ends'], ('never', ''))
+            eq_(res.count_tot, 5)
+            eq_(res.count_parsed, 3)
+            eq_(res.dups, set(['192.168.1.10']))
+
+    def test_lookups(self):
+        self.write(LEASES + """
+lease 192.168.1.14 {
+  binding state active;
+  hardware ethernet 00:11:22:33:44:56;
+  client-hostname "host-b";
+}
+""")
+        res = self.parse('tokenizer')
+        eq_(res.get_host_by_ip('192.168.1.11')['mac_addr'], '00:11:22:33:44:56')
+        eq_(res.get_host_by_ip('192.168.1.12'), None)
+        eq_(res.get_host_by_mac('00:11:22:33:44:56')['ip_addr'], '192.168.1.14')
+        # 192.168.1.10 was superseded by a lease with another MAC address
+        eq_(res.get_host_by_mac('00:11:22:33:44:55'), None)
+        eq_(res.get_host_by_mac('00:11:22:33:44:99')['ip_addr'], '192.168.1.10')
+        eq_([h['ip_addr'] for h in res.get_hosts_by_hostname('host-b')],
+            ['192.168.1.10', '192.168.1.14'])
+        eq_(res.get_hosts_by_hostname('host-a'), [])
+        eq_([h['ip_addr'] for h in res.get_hosts()],
+            ['192.168.1.10', '192.168.1.11', '192.168.1.14'])
+
+    def test_shared_hostname(self):
+        """ Many hosts share a hostname, and some their MAC address """
+        rnd = random.Random(5)
+        table = dhcp.HostTable()
+        updates = []
+        for n in range(2000):
+            i = rnd.randrange(500)
+            host = {'ip_addr': '10.0.%d.%d' % (i // 256, i % 256),
+                    'mac_addr': 'mac-%d' % rnd.randrange(5),
+                    'client_hostname': rnd.choice(['iPhone', 'iPhone', ''])}
+            table.put(host)
+            updates.append(host)
+        # The least recently updated first, as in the table
+        last = dict((host['ip_addr'], (n, host))
+                    for n, host in enumerate(updates))
+        latest = [host for n, host in sorted(last.values())]
+        for loaded in (table, dhcp.HostTable.load(table.dump())):
+            eq_(loaded.get_by_hostname('iPhone'),
+                [h for h in latest if h['client_hostname'] == 'iPhone'])
+            for m in range(5):
+                eq_(loaded.get_by_mac('mac-%d' % m),
+                    [h for h in latest if h['mac_addr'] == 'mac-%d' % m][-1])
+            eq_(loaded.get_by_hostname(''), [])
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, DhcpLeasesParser, self.filename,
+                          engine='foo')
+
+    def assert_same(self, a, b):
+        eq_(a.get_hosts(), b.get_hosts())
+        eq_(a.count_tot, b.count_tot)
+        eq_(a.count_parsed, b.count_parsed)
+        eq_(a.dups, b.dups)
+        eq_(a.get_leases(), b.get_leases())
+
+    def test_differential(self):
+        """ The tokenizer gives the same results as the PyParsing grammar """
+        rnd = random.Random(42)
+        for i in range(3):
+            self.write(random_leases(rnd, 300))
+            self.assert_same(self.parse('pyparsing'), self.parse('tokenizer'))
+
+    @patch('dhcp.READ_SIZE', 7)
+    def test_tokenizer_small_blocks(self):
+        self.write(random_leases(random.Random(1), 50))
+        self.assert_same(self.parse('pyparsing'), self.parse('tokenizer'))
+
+    def append(self, text):
+        with open(self.filename, 'ab') as f:
+            f.write(text)
+
+    def test_refresh(self):
+        """ Parsing appended blocks gives the same result as a full parse """
+        text = random_leases(random.Random(7), 200)
+        cuts = sorted(random.Random(8).sample(range(len(text)), 10))
+        for engine in dhcp.ENGINES:
+            self.write('')
+            res = DhcpLeasesParser(self.filename, engine=engine)
+            res.parse()
+            for a, b in zip([0] + cuts, cuts + [len(text)]):
+                # Blocks can be cut anywhere, even in the middle of a line
+                self.append(text[a:b])
+                res.refresh()
+                self.assertTrue(res.offset <= b)
+            eq_(res.offset, len(text))
+            self.assert_same(res, self.parse(engine))
+
+    def test_refresh_partial_block(self):
+        self.write(LEASES)
+        res = self.parse('tokenizer')
+        self.append("lease 192.168.1.20 {\n  binding state active;\n")
+        res.refresh()
+        eq_(res.get_host_by_ip('192.168.1.20'), None)
+        eq_(res.count_tot, 5)
+        self.append("  client-hostname \"host-c\";\n}\n")
+        res.refresh()
+        eq_(res.get_host_by_ip('192.168.1.20')['client_hostname'], 'host-c')
+        eq_(res.count_tot, 6)
+        eq_(res.count_parsed, 4)
+
+    def test_refresh_rewritten(self):
+        """ A rewritten or truncated file is parsed again from scratch """
+        self.write(LEASES)
+        res = self.parse('tokenizer')
+        # Same size, other contents
+        self.write(LEASES.replace('host-b', 'host-x'))
+        res.refresh()
+        eq_(res.get_hosts_by_hostname('host-b'), [])
+        eq_(len(res.get_hosts_by_hostname('host-x')), 1)
+        eq_(res.dups, set(['192.168.1.10']))
+        # New file, as dhcpd does when it rewrites the leases
+        os.remove(self.filename)
+        self.write(LEASES[:LEASES.rindex('lease 192.168.1.10')])
+        res.refresh()
+        eq_(res.get_host_by_mac('00:11:22:33:44:99'), None)
+        eq_(res.count_tot, 4)
+        eq_(res.dups, set())
+        self.assert_same(res, self.parse('tokenizer'))
+
+    def test_refresh_error(self):
+        """ A failed parse does not count the same entries again """
+        bad = "lease 192.168.1.30 {\n  starts 4 2015/02/30 10:58:00;\n}\n"
+        for engine in dhcp.ENGINES:
+            self.write(LEASES)
+            res = self.parse(engine)
+            self.append(LEASES + bad)
+            for i in range(3):
+                self.assertRaises(ValueError, res.refresh)
+                eq_(res.count_tot, 0)
+                eq_(res.dups, set())
+            self.write(LEASES + LEASES)
+            res.refresh()
+            eq_(res.count_tot, 10)
+            self.assert_same(res, self.parse(engine))
+
+    def test_compact(self):
+        """ Host records hold the same values as the host dicts """
+        self.write(random_leases(random.Random(5), 300) + LEASES)
+        for engine in dhcp.ENGINES:
+            res = self.parse(engine)
+            compact = DhcpLeasesParser(self.filename, engine=engine,
+                                       compact=True)
+            compact.parse()
+            self.assert_same(res, compact)
+            eq_([h.as_dict() for h in compact.get_hosts()], res.get_hosts())
+        host = compact.get_host_by_ip('192.168.1.11')
+        eq_(host['ends'], ('never', ''))
+        eq_(host.ends_epoch, dhcp.NEVER)
+        eq_(host.starts_epoch, 1439463480)
+        eq_(host.get('cltt'), ('', ''))
+        eq_(host.get('foo'), None)
+        self.assertRaises(KeyError, lambda: host['foo'])
+
+    def test_decode_timestamp(self):
+        with local_tz('UTC'):
+            eq_(dhcp.decode_timestamp('2015/08/13', '10:58:00'),
+                (1439463480, '2015-08-13', '10:58:00'))
+        with local_tz('America/New_York'):
+            eq_(dhcp.decode_timestamp('2015/08/13', '10:58:00'),
+                (1439463480, '2015-08-13', '06:58:00'))
+        for date, tm in (('15/08/13', '10:58:00'), ('2015/02/29', '10:58:00'),
+                         ('2015/08/13', '24:00:00'), ('2015/08/13', '1:2:3'),
+                         ('2015/8/13', '10:58:00'), ('2015/08/13', '10:58:60')):
+            self.assertRaises(ValueError, dhcp.decode_timestamp, date, tm)
+
+    def test_utc2localtime_dst(self):
+        with local_tz('Europe/Paris'):
+            eq_(dhcp.utc2localtime('2015/08/13', '10:58:00'),
+                ('2015-08-13', '12:58:00'))
+            eq_(dhcp.utc2localtime('2015/01/13', '10:58:00'),
+                ('2015-01-13', '11:58:00'))
+            eq_(dhcp.epoch2localtime(1439463480), ('2015-08-13', '12:58:00'))
+
+    def test_snapshot(self):
+        """ A new parser starts from the snapshot of the previous one """
+        text = random_leases(random.Random(11), 300)
+        half = text.index('lease', len(text) // 2)
+        self.write(text[:half])
+        snapshot = self.filename + dhcp.SNAPSHOT_SUFFIX
+        self.addCleanup(lambda: os.path.exists(snapshot) and
+                        os.remove(snapshot))
+        for compact in (False, True):
+            res = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                   compact=compact, snapshot=True)
+            res.parse()
+            ok_(os.path.exists(snapshot))
+            # Nothing to parse again
+            warm = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                    compact=compact, snapshot=True)
+            with patch.object(DhcpLeasesParser, '_add_lease') as add_lease:
+                warm.parse()
+            eq_(add_lease.call_count, 0)
+            self.assert_same(res, warm)
+        # Only the appended leases are parsed
+        self.append(text[half:])
+        warm = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                compact=True, snapshot=True)
+        with patch.object(DhcpLeasesParser, '_add_lease') as add_lease:
+            warm.parse()
+        eq_(add_lease.call_count,
+            len(list(LeasesTokenizer().scan([text[half:]]))))
+        warm = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                snapshot=True)
+        warm.parse()
+        self.assert_same(warm, self.parse('pyparsing'))
+
+    def test_snapshot_refresh(self):
+        """ The snapshot is not saved again on each incremental parse """
+        text = random_leases(random.Random(12), 100)
+        half = text.index('lease', len(text) // 2)
+        self.write(text[:half])
+        snapshot = self.filename + dhcp.SNAPSHOT_SUFFIX
+        self.addCleanup(os.remove, snapshot)
+        res = DhcpLeasesParser(self.filename, engine='tokenizer',
+                               snapshot=True)
+        res.parse()
+        self.append(text[half:])
+        with patch.object(DhcpLeasesParser, '_save_snapshot') as save:
+            res.refresh()
+            res.save_snapshot()
+        eq_(save.call_count, 1)
+        res.save_snapshot()
+        with patch.object(DhcpLeasesParser, '_save_snapshot') as save:
+            res.save_snapshot()
+        eq_(save.call_count, 0)
+        # Nothing to parse again
+        warm = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                snapshot=True)
+        with patch.object(DhcpLeasesParser, '_add_lease') as add_lease:
+            warm.parse()
+        eq_(add_lease.call_count, 0)
+        self.assert_same(res, warm)
+
+    def test_snapshot_new_process(self):
+        """ A process which parsed appended leases saves the snapshot """
+        text = random_leases(random.Random(14), 90)
+        cuts = [text.index('lease', len(text) * n // 3) for n in (1, 2)]
+        self.write(text[:cuts[0]])
+        snapshot = self.filename + dhcp.SNAPSHOT_SUFFIX
+        self.addCleanup(os.remove, snapshot)
+        DhcpLeasesParser(self.filename, engine='tokenizer',
+                         snapshot=True).parse()
+        for a, b in zip(cuts, cuts[1:] + [len(text)]):
+            self.append(text[a:b])
+            res = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                   snapshot=True)
+            with patch.object(DhcpLeasesParser, '_add_lease', autospec=True,
+                              side_effect=DhcpLeasesParser._add_lease) \
+                    as add_lease:
+                res.parse()
+            # Only what was appended since the previous process
+            eq_(add_lease.call_count,
+                len(list(LeasesTokenizer().scan([text[a:b]]))))
+        res = DhcpLeasesParser(self.filename, engine='tokenizer',
+                               snapshot=True)
+        with patch.object(DhcpLeasesParser, '_save_snapshot') as save:
+            res.parse()
+        eq_(save.call_count, 0)
+        self.assert_same(res, self.parse('tokenizer'))
+
+    def test_snapshot_invalid(self):
+        self.write(LEASES)
+        snapshot = self.filename + '.snap'
+        self.addCleanup(os.remove, snapshot)
+        DhcpLeasesParser(self.filename, snapshot=snapshot).parse()
+        # A new file
+        os.remove(self.filename)
+        self.write(LEASES.replace('host-b', 'host-x'))
+        res = DhcpLeasesParser(self.filename, snapshot=snapshot)
+        res.parse()
+        eq_(len(res.get_hosts_by_hostname('host-x')), 1)
+        # A corrupted snapshot
+        with open(snapshot, 'wb') as f:
+            f.write('garbage')
+        res = DhcpLeasesParser(self.filename, snapshot=snapshot)
+        res.parse()
+        eq_(len(res.get_hosts_by_hostname('host-x')), 1)
+
+    def test_time_queries(self):
+        """ The time index gives the same hosts as scanning all of them """
+        self.write(random_leases(random.Random(13), 500))
+        for compact in (False, True):
+            res = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                   compact=compact)
+            res.parse()
+            hosts = dict((h['ip_addr'], h) for h in res.get_hosts())
+            times = res.times._times
+            ok_(times)
+            rnd = random.Random(14)
+            for i in range(50):
+                t = rnd.randint(1420070400, 1451606400)
+                eq_(sorted(h['ip_addr'] for h in res.active_at(t)),
+                    sorted(ip for ip, (starts, ends, changed)
+                           in times.iteritems()
+                           if starts is not None and starts <= t < ends))
+                expiring = res.expiring_within(86400 * 7, now=t)
+                eq_(sorted(h['ip_addr'] for h in expiring),
+                    sorted(ip for ip, (starts, ends, changed)
+                           in times.iteritems()
+                           if t <= ends < t + 86400 * 7))
+                eq_(sorted(h['ip_addr'] for h in res.changed_since(t)),
+                    sorted(ip for ip, (starts, ends, changed)
+                           in times.iteritems()
+                           if changed is not None and changed >= t))
+            for ip, host in hosts.iteritems():
+                eq_(res.times._times[ip][0] is None, host['starts'] == ('', ''))
+        for host in res.get_hosts():
+            eq_(host.ends_epoch or dhcp.NEVER, times[host.ip_addr][1])
+        ok_(res.active_at(1439463480))
+        eq_(res.active_at(0), [])
+
+    @patch('dhcp.PARALLEL_CHUNK_SIZE', 1000)
+    def test_parallel(self):
+        """ A parallel parse gives the same results as a serial one """
+        text = random_leases(random.Random(17), 400)
+        # Lines starting with 'lease' which do not start a lease block
+        text = text.replace('  binding state free;\n',
+                            '  binding state free;\nlease\n', 5)
+        self.write(text)
+        ranges = dhcp.split_ranges(text, 0, len(text), 8)
+        ok_(len(ranges) > 4)
+        eq_(''.join(text[a:b] for a, b in ranges), text)
+        for a, b in ranges[1:]:
+            ok_(text[a:].startswith('lease '))
+        for engine in dhcp.ENGINES:
+            for compact in (False, True):
+                serial = DhcpLeasesParser(self.filename, engine=engine,
+                                          compact=compact)
+                serial.parse()
+                parallel = DhcpLeasesParser(self.filename, engine=engine,
+                                            compact=compact, jobs=2)
+                parallel.parse()
+                self.assert_same(serial, parallel)
+                eq_(serial.times._times, parallel.times._times)
+
+    def test_history(self):
+        self.write(LEASES)
+        for engine in dhcp.ENGINES:
+            res = DhcpLeasesParser(self.filename, engine=engine, history=8)
+            res.parse()
+            events = res.get_history_by_ip('192.168.1.10')
+            eq_([(e.mac_addr, e.binding_state) for e in events],
+                [('00:11:22:33:44:55', 'active'),
+                 ('00:11:22:33:44:99', 'active')])
+            eq_(events[0].starts, 1439463480)
+            eq_(res.get_history_by_ip('192.168.1.11')[0].ends, dhcp.NEVER)
+            eq_(res.get_history_by_ip('192.168.1.13')[0],
+                (None, None, '192.168.1.13', '', 'free'))
+            eq_([e.ip_addr for e in
+                 res.get_history_by_mac('00:11:22:33:44:56')],
+                ['192.168.1.11'])
+            eq_(res.get_history_by_ip('192.168.1.12'), [])
+        eq_(self.parse('tokenizer').get_history_by_ip('192.168.1.10'), [])
+
+    @patch('dhcp.PARALLEL_CHUNK_SIZE', 1000)
+    def test_history_depth(self):
+        """ Only the last entries are kept, also with a parallel parse """
+        text = random_leases(random.Random(19), 400)
+        self.write(text)
+        full = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                history=1000)
+        full.parse()
+        for jobs in (1, 2):
+            res = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                   history=3, jobs=jobs)
+            res.parse()
+            for ip in full.get_leases():
+                eq_(res.get_history_by_ip(ip),
+                    full.get_history_by_ip(ip)[-3:])
+            ok_(max(len(events) for events in full.history._by_ip.values())
+                > 3)
+        # The history is saved in the snapshot
+        snapshot = self.filename + '.snap'
+        self.addCleanup(os.remove, snapshot)
+        for i in range(2):
+            res = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                   history=3, snapshot=snapshot)
+            res.parse()
+            eq_(res.get_history_by_ip('10.0.1.1'),
+                full.get_history_by_ip('10.0.1.1')[-3:])
+
+    def run_main(self, args):
+        out = StringIO()
+        with patch('sys.stdout', out):
+            eq_(dhcp.main(args + [self.filename]), 0)
+        return out.getvalue()
+
+    def test_main_formats(self):
+        self.write(random_leases(random.Random(23), 200))
+        rows = list(DhcpLeasesParser(self.filename).iter_leases())
+        eq_(rows, list(DhcpLeasesParser(self.filename,
+                                        engine='tokenizer').iter_leases()))
+        for fmt in ('csv', 'tsv'):
+            out = self.run_main(['-f', fmt])
+            lines = list(csv.reader(StringIO(out), delimiter=',' if
+                                    fmt == 'csv' else '\t'))
+            eq_(lines[0], list(dhcp.DEFAULT_FIELDS))
+            eq_(lines[1:], [[row[field] for field in dhcp.DEFAULT_FIELDS]
+                            for row in rows])
+        out = self.run_main(['-f', 'jsonl', '-a', '-F', 'ip_addr,ends,uid'])
+        lines = [json.loads(line) for line in out.splitlines()]
+        eq_(lines, [{'ip_addr': row['ip_addr'], 'ends': row['ends'],
+                     'uid': row['uid']}
+                    for row in rows if row['binding_state'] == 'active'])
+        ok_(len(lines) < len(rows))
+
+    def test_main(self):
+        self.write(LEASES)
+        with local_tz('UTC'):
+            row = next(DhcpLeasesParser(self.filename).iter_leases())
+        # The uid is written in hex, its octal escapes decoded
+        eq_(row['uid'], '01:00:11:22:33:44:55')
+        with local_tz('UTC'):
+            eq_(row, next(DhcpLeasesParser(self.filename,
+                                           engine='tokenizer').iter_leases()))
+        eq_(dhcp.unescape(r'a\"\\\tb\7\1011'), 'a"\\\tb\x07A1')
+        eq_(row['next_binding_state'], 'free')
+        eq_(row['starts'], '2015-08-13 10:58:00')
+        eq_(row['hardware_type'], 'ethernet')
+        with patch('dhcp.DhcpLeasesParser', wraps=DhcpLeasesParser) as cls:
+            out = self.run_main([])
+            eq_(cls.call_args[1]['engine'], 'pyparsing')
+            self.run_main(['-f', 'csv'])
+            eq_(cls.call_args[1]['engine'], 'tokenizer')
+        ok_('Found 5 lease entries in file' in out)
+        for args in (['-f', 'xml'], ['-F', 'ip_addr,foo'], ['-e', 'foo']):
+            with patch('sys.stderr', StringIO()):
+                with patch('sys.stdout', StringIO()):
+                    eq_(dhcp.main(args + [self.filename]), 1)
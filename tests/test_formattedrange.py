@@ -1,6 +1,13 @@
+import os
+import random
 import unittest
 from nose.tools import eq_, ok_
-from formattedrange import FormattedRange, FormattedDateRange, main
+from formattedrange import (FormattedRange, FormattedDateRange, main,
+                            write_chunked, merge_intervals, IntervalList,
+                            LRUCache, template_cache, intersect_intervals,
+                            subtract_intervals, intervals_to_str, collapse,
+                            write_batch, input_ready)
+from formattedrange import FormattedRangeError, FormattedDateRangeError
 from StringIO import StringIO
 from mock import __version__ as mock_ver
 assert int(mock_ver.split('.')[0]) >= 1, "mock version: %s <= 1.0 " % mock_ver
@@ -41,6 +48,257 @@ class TestFormattedrange(unittest.TestCase):
         for i in not_expected:
             ok_(i not in res)
 
+    def test_iter_is_lazy(self):
+        fr = FormattedRange("node[0001-9999]rack[01-64]")
+        it = fr.iter()
+        eq_(next(it), "node0001rack01")
+        eq_(next(it), "node0001rack02")
+
+    def test_iter_same_as_get(self):
+        fr = FormattedRange("a[1-2,4-5]b[6-7,9-10]c")
+        eq_(list(fr), fr.get())
+
+    def test_len(self):
+        eq_(len(FormattedRange("a[1-100000]b[1-100000]")), 10 ** 10)
+        eq_(FormattedRange("a[1-2,4-5]b[6-7,9-10]c").count(), 16)
+        eq_(len(FormattedRange("abc")), 1)
+
+    def test_getitem(self):
+        fr = FormattedRange("a[1-2,4-5]b[06-07,09-10]c")
+        res = fr.get()
+        for n in range(len(res)):
+            eq_(fr[n], res[n])
+        eq_(fr[-1], res[-1])
+        self.assertRaises(IndexError, fr.__getitem__, len(res))
+
+    def test_getitem_huge(self):
+        fr = FormattedRange("a[1-100000]b[1-100000]")
+        eq_(fr[0], "a1b1")
+        eq_(fr[100001], "a2b2")
+        eq_(fr[-1], "a100000b100000")
+
+    def test_slice(self):
+        fr = FormattedRange("a[1-3]b[1-4]c[1-2]")
+        res = fr.get()
+        eq_(fr[5:17], res[5:17])
+        eq_(fr[3:], res[3:])
+        eq_(fr[:-3], res[:-3])
+        eq_(fr[1:20:3], res[1:20:3])
+        eq_(fr[10:5], [])
+
+    def test_rangewcomma_huge(self):
+        fr = FormattedRange("a[0-10000000,20000000-30000000]")
+        eq_(len(fr), 20000002)
+        eq_(fr[10000001], "a20000000")
+        eq_(fr._int_ls[0][1].intervals, ((0, 10000000), (20000000, 30000000)))
+
+    def test_contains(self):
+        fr = FormattedRange("b[0001-0500,0700-0900]")
+        ok_(fr.contains("b0734"))
+        ok_("b0001" in fr)
+        ok_("b0600" not in fr)
+        ok_("b734" not in fr)
+        ok_("b00734" not in fr)
+        ok_("c0734" not in fr)
+        ok_("b0734x" not in fr)
+        eq_(fr.index("b0734"), 534)
+        eq_(fr[fr.index("b0734")], "b0734")
+        self.assertRaises(ValueError, fr.index, "b0600")
+
+    def test_index_multiple(self):
+        fr = FormattedRange("a[1-2,4-5]b[06-07,09-10]c")
+        for n, i in enumerate(fr.get()):
+            eq_(fr.index(i), n)
+        fr = FormattedRange("[1-12][1-3]")
+        for n, i in enumerate(fr.get()):
+            eq_(fr[fr.index(i)], i)
+        fr = FormattedRange("abc")
+        eq_(fr.index("abc"), 0)
+        ok_("ab" not in fr)
+
+    def test_shard(self):
+        fr = FormattedRange("a[1-7]b[1-3]")
+        res = fr.get()
+        shards = [list(fr.shard(k, 4)) for k in range(1, 5)]
+        eq_(sum(shards, []), res)
+        eq_([len(i) for i in shards], [5, 5, 5, 6])
+        eq_(fr.shard_bounds(2, 4), (5, 10))
+        self.assertRaises(ValueError, fr.shard_bounds, 0, 4)
+
+    def test_sort(self):
+        fr = FormattedRange("a[1-50,20-80,81-90]b", sort=True)
+        eq_(fr.get(), ["a%db" % i for i in range(1, 91)])
+        fr = FormattedRange("a[07-09,01-03,02,08]", sort=True)
+        eq_(fr.get(), ["a01", "a02", "a03", "a07", "a08", "a09"])
+
+    def test_sort_huge(self):
+        fr = FormattedRange("a[0-10000000,5-20000000,20000001-30000000]",
+                            sort=True)
+        eq_(len(fr), 30000001)
+        eq_(fr[-1], "a30000000")
+
+    def test_merge_intervals(self):
+        eq_(merge_intervals([(81, 90), (1, 50), (20, 80)]), [(1, 90)])
+        eq_(merge_intervals([(5, 7), (1, 3), (3, 3)]), [(1, 3), (5, 7)])
+        eq_(merge_intervals([(3, 1)]), [])
+
+    def test_interval_list(self):
+        il = IntervalList([(1, 3), (10, 10), (20, 22)])
+        eq_(len(il), 7)
+        eq_(list(il), [1, 2, 3, 10, 20, 21, 22])
+        eq_([il[i] for i in range(len(il))], list(il))
+        eq_(il[-1], 22)
+        self.assertRaises(IndexError, il.__getitem__, 7)
+        eq_([il.index(i) for i in il], range(len(il)))
+        ok_(4 not in il)
+        il = IntervalList([(20, 22), (1, 3), (2, 5)])
+        eq_(il.index(2), 4)
+        eq_(il.index(5), 9)
+
+class TestSetOperations(unittest.TestCase):
+
+    def check_derived(self, res):
+        """ The pattern of a derived range expands to the same strings """
+        eq_(FormattedRange(res._s).get(), res.get())
+
+    def test_intervals(self):
+        eq_(intersect_intervals([(1, 10), (20, 30)], [(5, 25)]),
+            [(5, 10), (20, 25)])
+        eq_(subtract_intervals([(1, 10), (20, 30)], [(3, 4), (8, 21)]),
+            [(1, 2), (5, 7), (22, 30)])
+        eq_(subtract_intervals([(1, 10)], [(1, 10)]), [])
+        eq_(intervals_to_str([(1, 3), (7, 7)], 2), "01-03,07")
+
+    def test_difference(self):
+        nodes = FormattedRange("b[0001-0500,0700-0900]")
+        drained = FormattedRange("b[0010-0020,0400-0800]")
+        res = nodes - drained
+        eq_(res.get(), sorted(set(nodes.get()) - set(drained.get())))
+        eq_(str(res._s), "b[0001-0009,0021-0399,0801-0900]")
+        self.check_derived(res)
+        eq_(len(nodes - nodes), 0)
+        eq_((nodes - FormattedRange("b[1000-2000]")).get(), nodes.get())
+
+    def test_intersection(self):
+        a = FormattedRange("a[1-5]b[01-10]")
+        b = FormattedRange("a[4-8]b[05-20]")
+        eq_((a & b).get(), sorted(set(a.get()) & set(b.get())))
+        self.check_derived(a & b)
+
+    def test_union(self):
+        a = FormattedRange("a[1-5]b[01-10]")
+        b = FormattedRange("a[4-8]b[01-10]")
+        eq_(sorted((a | b).get()), sorted(set(a.get()) | set(b.get())))
+        c = FormattedRange("a[2-3]b[02-03]")
+        eq_((a | c).get(), a.get())
+        self.check_derived(a | b)
+        res = FormattedRange("b[0]") | FormattedRange("b[11-12]")
+        eq_(res._s, "b[0,11-12]")
+        eq_(res.get(), ["b0", "b11", "b12"])
+        self.check_derived(res)
+        self.check_derived(FormattedRange("b[00-05]") - FormattedRange("b[01]"))
+        self.assertRaises(FormattedRangeError, a.union,
+                          FormattedRange("a[4-8]b[05-20]"))
+
+    def test_shape(self):
+        a = FormattedRange("a[1-5]b")
+        self.assertRaises(FormattedRangeError, a.union, FormattedRange("a[1-5]c"))
+        self.assertRaises(FormattedRangeError, a.union, FormattedRange("a[01-05]b"))
+
+class TestCollapse(unittest.TestCase):
+
+    def test_collapse(self):
+        eq_(collapse(["b01", "b02", "b03", "b07"]), ["b[01-03,07]"])
+        eq_(collapse(["b07", "b01", "b03", "b02", "b03"]), ["b[01-03,07]"])
+        eq_(collapse(["b1", "b2", "b10", "c5", "host"]),
+            ["host", "b[1-2,10]", "c5"])
+
+    def test_collapse_zfill(self):
+        eq_(collapse(["b01", "b10", "b2", "b100"]), ["b[2,100]", "b[01,10]"])
+        eq_(collapse(["n001r1", "n002r1", "n003r2"]),
+            ["n[001-002]r1", "n003r2"])
+        eq_(collapse(["r1n001", "r1n002", "r2n003"]),
+            ["r2n003", "r1n[001-002]"])
+
+    def test_collapse_roundtrip(self):
+        fr = FormattedRange("node[0001-0500,0700-0900]x")
+        res = collapse(fr.iter())
+        eq_(res, ["node[0001-0500,0700-0900]x"])
+        fr = FormattedRange("b[01,07]")
+        eq_(fr.get(), ["b01", "b07"])
+        eq_(collapse(fr), ["b[01,07]"])
+
+    def test_collapse_fields(self):
+        fr = FormattedRange("node[0001-0120]rack[01-64]")
+        eq_(collapse(fr.iter()), ["node[0001-0120]rack[01-64]"])
+        eq_(collapse(["b0", "b26", "b27"]), ["b[0,26-27]"])
+        eq_(FormattedRange("b[0,26-27]").get(), ["b0", "b26", "b27"])
+
+    def test_collapse_expand(self):
+        """ Expanding what collapse() returns gives the names back """
+        rnd = random.Random(3)
+        for i in range(300):
+            names = set()
+            for j in range(rnd.randrange(1, 30)):
+                name = rnd.choice(['', 'b', 'n', 'x-'])
+                for k in range(rnd.randrange(1, 4)):
+                    num = str(rnd.choice([0, 1, 2, 9, 10, 11, 99, 100,
+                                          rnd.randrange(200)]))
+                    name += num.zfill(rnd.choice([0, 0, 2, 3]))
+                    name += rnd.choice(['', 'r', '.'])
+                names.add(name)
+            res = collapse(names)
+            expanded = [el for r in res for el in FormattedRange(r).iter()]
+            eq_(sorted(expanded), sorted(names), (names, res))
+
+class TestTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        template_cache.clear()
+
+    def test_cache_hit(self):
+        fr1 = FormattedRange("a[1-3]b")
+        fr2 = FormattedRange("a[1-3]b")
+        eq_(template_cache.info()['misses'], 1)
+        eq_(template_cache.info()['hits'], 1)
+        ok_(fr1._int_ls[0][1] is fr2._int_ls[0][1])
+        eq_(fr2.get(), ["a1b", "a2b", "a3b"])
+
+    def test_cache_hit_other_text(self):
+        """ The brackets are parsed once whatever the text around them """
+        for i in range(100):
+            fr = FormattedRange("h%d-[01-03]x%d" % (i, i))
+            eq_(fr.get(), ["h%d-%02dx%d" % (i, n, i) for n in (1, 2, 3)])
+        eq_(template_cache.info()['misses'], 1)
+        eq_(template_cache.info()['hits'], 99)
+        eq_(FormattedRange("a[1-2]b[01-02]").get(),
+            ["a1b01", "a1b02", "a2b01", "a2b02"])
+        eq_(FormattedRange("c[1-2]d[01-02]e").get(),
+            ["c1d01e", "c1d02e", "c2d01e", "c2d02e"])
+        eq_(template_cache.info()['hits'], 100)
+        eq_(FormattedRange("h1-[1-3]").get(), ["h1-1", "h1-2", "h1-3"])
+
+    def test_cache_key(self):
+        eq_(FormattedRange("a[3-4,1-2]").get(), ["a3", "a4", "a1", "a2"])
+        eq_(FormattedRange("a[3-4,1-2]", sort=True).get(),
+            ["a1", "a2", "a3", "a4"])
+        FormattedDateRange("a[20120228-20120229]")
+        eq_(FormattedDateRange("a[20120228-20120229]", date_format="%d").get(),
+            ["a28", "a29"])
+        eq_(template_cache.info()['hits'], 0)
+
+    def test_lru(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        eq_(cache.get('a'), 1)
+        cache.put('c', 3)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('c'), 3)
+        eq_(len(cache), 2)
+        eq_(cache.info(), {'hits': 3, 'misses': 1, 'size': 2, 'maxsize': 2})
+
 class TestFormattedDateRange(unittest.TestCase):
 
     def test_date_range(self):
@@ -49,6 +307,51 @@ class TestFormattedDateRange(unittest.TestCase):
         for n, i in enumerate(fr.get()):
             eq_(i, "a%sb" % expected[n])
 
+    def test_date_range_long(self):
+        fr = FormattedDateRange("[20111230-20130102]", date_format="%Y-%m-%d")
+        res = fr.get()
+        eq_(len(res), 370)
+        eq_(res[:3], ["2011-12-30", "2011-12-31", "2012-01-01"])
+        eq_(res[61], "2012-02-29")
+        eq_(res[-1], "2013-01-02")
+        eq_(fr[61], "2012-02-29")
+        eq_(fr.index("2012-03-01"), 62)
+
+    def test_date_range_steps(self):
+        fr = FormattedDateRange("[2012022822-2012022901]",
+                                date_format="%d/%Hh", step='hour')
+        eq_(fr.get(), ["28/22h", "28/23h", "29/00h", "29/01h"])
+        fr = FormattedDateRange("[20120201-20120301]", step='week')
+        eq_(fr.get(), ["20120201", "20120208", "20120215", "20120222",
+                       "20120229"])
+        eq_(fr.index("20120215"), 2)
+        ok_("20120216" not in fr)
+        self.assertRaises(FormattedDateRangeError, FormattedDateRange,
+                          "[20120201-20120301]", step='month')
+
+    def test_date_range_yymmdd(self):
+        fr = FormattedDateRange("b[120227-120301]c", date_format="%y%m%d")
+        eq_(fr.get(), ["b120227c", "b120228c", "b120229c", "b120301c"])
+
+    def test_date_range_invalid(self):
+        self.assertRaises(FormattedDateRangeError, FormattedDateRange,
+                          "a[20120230-20120301]b")
+        self.assertRaises(FormattedDateRangeError, FormattedDateRange,
+                          "a[2012022-20120301]b")
+
+    def test_date_range_contains(self):
+        fr = FormattedDateRange("a[20120228-20120301]b", date_format="%m%d")
+        ok_("a0229b" in fr)
+        ok_("a0302b" not in fr)
+        eq_(fr.index("a0301b"), 2)
+
+    def test_date_range_multiple(self):
+        fr = FormattedDateRange("a[20120228-20120229]b[20120301-20120302]")
+        eq_(fr.get(), ["a20120228b20120301", "a20120228b20120302",
+                       "a20120229b20120301", "a20120229b20120302"])
+        eq_(len(fr), 4)
+        eq_(fr[-1], "a20120229b20120302")
+
 
 class TestCliOptions(unittest.TestCase):
 
@@ -63,3 +366,100 @@ class TestCliOptions(unittest.TestCase):
         eq_(mock_stdout.getvalue(), 'a1b a2b\n')
 
 
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_main_multiple_strings(self, mock_stdout):
+        args = ['-d', ',', 'a[1-2]b', 'c[01-02]']
+        main(args)
+        eq_(mock_stdout.getvalue(), 'a1b,a2b,c01,c02\n')
+
+    def test_write_chunked(self):
+        out = StringIO()
+        count = write_chunked(FormattedRange("a[1-100]").iter(), out,
+                              delim='\n', chunk_size=16)
+        eq_(count, 100)
+        eq_(out.getvalue(), '\n'.join(FormattedRange("a[1-100]").get()))
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_main_sort(self, mock_stdout):
+        args = ['-s', 'a[3-4,1-3]b']
+        main(args)
+        eq_(mock_stdout.getvalue(), 'a1b a2b a3b a4b\n')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stdin', new_callable=StringIO)
+    def test_main_batch(self, mock_stdin, mock_stdout):
+        mock_stdin.write("a[1-2]b\n\nc[01-02]\n")
+        mock_stdin.seek(0)
+        eq_(main(['-b']), 0)
+        eq_(mock_stdout.getvalue(), 'a1b a2b\n\nc01 c02\n')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stdin', new_callable=StringIO)
+    def test_main_batch_separators(self, mock_stdin, mock_stdout):
+        mock_stdin.write("a[1-2]b\nc[01-02]")
+        mock_stdin.seek(0)
+        eq_(main(['-b', '-d', ',', '-r', ';']), 0)
+        eq_(mock_stdout.getvalue(), 'a1b,a2b;c01,c02;')
+
+    def test_write_batch(self):
+        out = StringIO()
+        out.flushed = []
+        out.flush = lambda: out.flushed.append(out.getvalue())
+        write_batch(["a[1-2]b\n", "c[01-02]\n"], FormattedRange, out,
+                    ready=lambda: False)
+        eq_(out.flushed[:2], ['a1b a2b\n', 'a1b a2b\nc01 c02\n'])
+        # Nothing is flushed while more input is ready
+        del out.flushed[:]
+        write_batch(["a[1-2]b\n", "c[01-02]\n"], FormattedRange, out,
+                    ready=lambda: True)
+        eq_(out.flushed, [out.getvalue()])
+
+    def test_input_ready(self):
+        eq_(input_ready(StringIO()), None)
+        rfd, wfd = os.pipe()
+        with os.fdopen(rfd) as rfile:
+            ready = input_ready(rfile)
+            ok_(not ready())
+            os.write(wfd, 'a[1-2]\n')
+            ok_(ready())
+            os.close(wfd)
+
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_main_batch_args(self, mock_stdout, mock_stderr):
+        eq_(main(['-b', 'a[1-2]']), 1)
+        ok_(mock_stderr.getvalue().startswith('Error: -b'))
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('sys.stdin', new_callable=StringIO)
+    def test_main_collapse(self, mock_stdin, mock_stdout):
+        mock_stdin.write("b01 b02\nb03 b07\nc1\n")
+        mock_stdin.seek(0)
+        eq_(main(['-c', '-']), 0)
+        eq_(mock_stdout.getvalue(), 'b[01-03,07] c1\n')
+
+    @patch('sys.stderr', new_callable=StringIO)
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_main_collapse_no_input(self, mock_stdout, mock_stderr):
+        eq_(main(['-c']), 1)
+        ok_(mock_stderr.getvalue().startswith('Error:'))
+        eq_(main(['-c', 'b1', 'b2']), 0)
+        ok_(mock_stdout.getvalue().endswith('b[1-2]\n'))
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_main_shard(self, mock_stdout):
+        main(['--shard', '2/3', 'b[1-9]', 'c[1-3]'])
+        eq_(mock_stdout.getvalue(), 'b4 b5 b6 c2\n')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    @patch('formattedrange.JOB_ITEMS', 7)
+    def test_main_jobs(self, mock_stdout):
+        main(['-j', '2', '-d', ',', 'a[1-5]b[01-10]', 'c[1-3]'])
+        expected = FormattedRange('a[1-5]b[01-10]').get() + ['c1', 'c2', 'c3']
+        eq_(mock_stdout.getvalue(), ','.join(expected) + '\n')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_main_date_step(self, mock_stdout):
+        main(['-f', '%H', '--step', 'hour', '[2012022822-2012022901]'])
+        eq_(mock_stdout.getvalue(), '22 23 00 01\n')
@@ -0,0 +1,208 @@
+import os
+import sys
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from nose.tools import eq_, ok_
+from mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'dhcp'))
+import leasewatcher
+from dhcp import DhcpLeasesParser
+from leasewatcher import (LeaseService, StatWatcher, InotifyWatcher,
+                          make_watcher, query)
+
+LEASE = """lease 10.0.0.%d {
+  starts 4 2015/08/13 10:58:00;
+  binding state active;
+  hardware ethernet 00:11:22:33:44:%02x;
+  client-hostname "host-%d";
+}
+"""
+
+
+class FakeDhcpd(threading.Thread):
+    """ Appends leases to the file, like dhcpd does, a few bytes at a time """
+    def __init__(self, filename, first, last):
+        threading.Thread.__init__(self)
+        self.filename = filename
+        self.leases = [LEASE % (n, n, n) for n in range(first, last)]
+
+    def run(self):
+        with open(self.filename, 'ab') as f:
+            for lease in self.leases:
+                for pos in range(0, len(lease), 40):
+                    f.write(lease[pos:pos + 40])
+                    f.flush()
+                    time.sleep(0.001)
+
+
+class TestLeaseService(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'dhcpd.leases')
+        self.socket_path = os.path.join(self.dir, 'leases.sock')
+        with open(self.filename, 'wb') as f:
+            f.write(LEASE % (1, 1, 1))
+        self.service = None
+
+    def tearDown(self):
+        if self.service:
+            self.service.stop()
+            self.thread.join()
+            self.service.close()
+        shutil.rmtree(self.dir)
+
+    def start(self, watcher):
+        parser = DhcpLeasesParser(self.filename, engine='tokenizer',
+                                  compact=True)
+        self.service = LeaseService(parser, self.socket_path, watcher)
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.start()
+
+    def wait_for(self, **request):
+        """ Returns the hosts found by the request, waiting for them """
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            hosts = query(self.socket_path, **request)['hosts']
+            if hosts:
+                return hosts
+            time.sleep(0.01)
+        self.fail("%s not found" % request)
+
+    def check_follow(self, watcher):
+        self.start(watcher)
+        hosts = query(self.socket_path, ip='10.0.0.1')['hosts']
+        eq_(hosts[0]['client_hostname'], 'host-1')
+        writer = FakeDhcpd(self.filename, 2, 30)
+        writer.start()
+        writer.join()
+        eq_(self.wait_for(ip='10.0.0.29')[0]['mac_addr'], '00:11:22:33:44:1d')
+        eq_(self.wait_for(mac='00:11:22:33:44:02')[0]['ip_addr'], '10.0.0.2')
+        eq_(len(self.wait_for(hostname='host-7')), 1)
+        eq_(query(self.socket_path, stats=True)['hosts'], 29)
+        # dhcpd rewrites the file from time to time
+        tmp = self.filename + '.new'
+        with open(tmp, 'wb') as f:
+            f.write(LEASE % (100, 100, 100))
+        os.rename(tmp, self.filename)
+        eq_(self.wait_for(ip='10.0.0.100')[0]['client_hostname'], 'host-100')
+        eq_(query(self.socket_path, ip='10.0.0.1'), {'hosts': []})
+
+    def test_follow_polling(self):
+        self.check_follow(StatWatcher(self.filename, 0.01))
+
+    def test_follow_inotify(self):
+        try:
+            watcher = InotifyWatcher(self.filename)
+        except OSError:
+            raise unittest.SkipTest("inotify is not available")
+        self.check_follow(watcher)
+
+    def test_errors(self):
+        self.start(make_watcher(self.filename, 0.01))
+        ok_('error' in query(self.socket_path, foo=1))
+        for request in ('not json', '[1]', '{"ip": [1]}'):
+            ok_('error' in self.service.answer(request))
+
+    def test_non_ascii(self):
+        with open(self.filename, 'ab') as f:
+            f.write((LEASE % (2, 2, 2)).replace('host-2', 'caf\xe9'))
+            f.write((LEASE % (3, 3, 3)).replace('host-3', 'caf\xc3\xa9'))
+        self.start(make_watcher(self.filename, 0.01))
+        eq_(query(self.socket_path, ip='10.0.0.2')['hosts'][0]
+            ['client_hostname'], u'caf\ufffd')
+        eq_(query(self.socket_path, hostname=u'caf\xe9')['hosts'][0]
+            ['ip_addr'], '10.0.0.3')
+        # The service still answers after an unexpected error
+        with patch.object(self.service.parser, 'get_host_by_ip',
+                          side_effect=RuntimeError('boom')):
+            ok_('boom' in query(self.socket_path, ip='10.0.0.1')['error'])
+        eq_(len(query(self.socket_path, ip='10.0.0.1')['hosts']), 1)
+
+    def test_many_clients(self):
+        self.start(make_watcher(self.filename))
+        results = []
+
+        def client():
+            for i in range(20):
+                results.append(query(self.socket_path, ip='10.0.0.1'))
+        clients = [threading.Thread(target=client) for i in range(20)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        eq_(len(results), 400)
+        ok_(all(r['hosts'][0]['mac_addr'] == '00:11:22:33:44:01'
+                for r in results))
+
+    @patch('leasewatcher.MAX_OUTPUT', 1000)
+    def test_slow_reader(self):
+        self.start(make_watcher(self.filename, 0.01))
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.socket_path)
+        conn.setblocking(False)
+        request = '{"ip": "10.0.0.1"}\n'
+        sent = 0
+        try:
+            # Until the server stops reading, as the client does not read
+            while sent < 100 * 1024 * 1024:
+                sent += conn.send(request * 100)
+        except socket.error:
+            pass
+        time.sleep(0.2)
+        buffered = [client[2] for client in self.service._clients.values()]
+        ok_(len(buffered[0]) < 1000 + 200)
+        # All the requests are answered once the client reads
+        conn.setblocking(True)
+        conn.settimeout(10)
+        answers = 0
+        while answers < sent // len(request):
+            answers += conn.recv(64 * 1024).count('\n')
+        conn.close()
+        eq_(answers, sent // len(request))
+
+    def test_not_a_socket(self):
+        with open(self.socket_path, 'w') as f:
+            f.write('data')
+        watcher = make_watcher(self.filename)
+        parser = DhcpLeasesParser(self.filename, engine='tokenizer')
+        self.assertRaises(OSError, LeaseService, parser, self.socket_path,
+                          watcher)
+        watcher.close()
+        with patch('sys.stderr'):
+            eq_(leasewatcher.main(['-s', self.socket_path, self.filename]), 1)
+        with open(self.socket_path) as f:
+            eq_(f.read(), 'data')
+
+    def test_sigterm(self):
+        """ SIGTERM closes the service: snapshot saved, socket removed """
+        self.addCleanup(signal.signal, signal.SIGTERM,
+                        signal.getsignal(signal.SIGTERM))
+
+        def kill():
+            deadline = time.time() + 10
+            while not os.path.exists(self.socket_path):
+                if time.time() > deadline:
+                    return
+                time.sleep(0.01)
+            os.kill(os.getpid(), signal.SIGTERM)
+        thread = threading.Thread(target=kill)
+        thread.start()
+        eq_(leasewatcher.main(['-s', self.socket_path, '--snapshot',
+                               self.filename]), 0)
+        thread.join()
+        ok_(not os.path.exists(self.socket_path))
+        ok_(os.path.exists(self.filename + '.snapshot'))
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    def test_main_usage(self, stdout, stderr):
+        eq_(leasewatcher.main(['-h']), 0)
+        eq_(leasewatcher.main(['-e', 'foo', self.filename]), 1)
+        eq_(leasewatcher.main([]), 1)